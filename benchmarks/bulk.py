@@ -0,0 +1,50 @@
+"""Compare building QPS graphs one at a time with building them in bulk.
+
+Usage: python benchmarks/bulk.py [ROWS]
+"""
+
+import sys
+import timeit
+
+from grafanalib import bulk, weave
+
+TITLE = '{service} QPS'
+EXPRESSIONS = [
+    'sum(irate(requests_total{{job="{service}",code=~"%s.."}}[1m]))' % code
+    for code in range(1, 6)
+]
+
+
+def per_row(services):
+    return [
+        weave.QPSGraph(
+            data_source='Prometheus',
+            title=TITLE.format(service=service),
+            expressions=[expr.format(service=service)
+                         for expr in EXPRESSIONS],
+        )
+        for service in services
+    ]
+
+
+def in_bulk(services):
+    return bulk.qps_graphs(
+        {'service': services},
+        data_source='Prometheus',
+        title=TITLE,
+        expressions=EXPRESSIONS,
+    )
+
+
+def main(args):
+    rows = int(args[0]) if args else 10000
+    services = ['service-{}'.format(i) for i in range(rows)]
+    assert per_row(services[:10]) == in_bulk(services[:10])
+    for f in (per_row, in_bulk):
+        seconds = min(timeit.repeat(lambda: f(services), number=1, repeat=3))
+        print('{:8} {:8.3f}s {:10.0f} rows/s'.format(
+            f.__name__, seconds, rows / seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,67 @@
+"""Compare writing dashboard JSON one file at a time with AtomicFileWriter.
+
+Usage: python benchmarks/write_dashboards.py [DASHBOARDS] [DIRECTORY]
+
+Pass a directory on the filesystem of interest, such as a network mount.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import grafanalib.core as G
+from grafanalib import _gen, weave
+
+
+def make_dashboards(count):
+    return [
+        G.Dashboard(title='Service {}'.format(i), rows=[G.Row(panels=[
+            weave.QPSGraph(
+                data_source='Prometheus', title='QPS',
+                expressions=[
+                    'sum(rate(requests_total{{job="{}",code=~"{}.."}}[1m]))'
+                    .format(i, code) for code in range(1, 6)]),
+        ])]).auto_panel_ids()
+        for i in range(count)
+    ]
+
+
+def one_at_a_time(dashboards, directory):
+    for i, dashboard in enumerate(dashboards):
+        path = os.path.join(directory, '{}.json'.format(i))
+        with open(path, 'w') as json_file:
+            _gen.write_dashboard(dashboard, json_file)
+
+
+def atomic(dashboards, directory):
+    with _gen.AtomicFileWriter() as writer:
+        for i, dashboard in enumerate(dashboards):
+            writer.write(os.path.join(directory, '{}.json'.format(i)),
+                         _gen.encode_dashboard(dashboard))
+
+
+def atomic_no_fsync(dashboards, directory):
+    with _gen.AtomicFileWriter(fsync=False) as writer:
+        for i, dashboard in enumerate(dashboards):
+            writer.write(os.path.join(directory, '{}.json'.format(i)),
+                         _gen.encode_dashboard(dashboard))
+
+
+def main(args):
+    count = int(args[0]) if args else 1000
+    directory = tempfile.mkdtemp(dir=args[1] if len(args) > 1 else None)
+    dashboards = make_dashboards(count)
+    try:
+        for f in (one_at_a_time, atomic, atomic_no_fsync):
+            seconds = min(timeit.repeat(
+                lambda: f(dashboards, directory), number=1, repeat=3))
+            print('{:16} {:8.3f}s {:10.0f} dashboards/s'.format(
+                f.__name__, seconds, count / seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,40 @@
+"""Time a Zabbix function pipeline over growing numbers of series.
+
+Usage: python benchmarks/zabbix_eval.py [POINTS]
+"""
+
+import sys
+import timeit
+
+import numpy as np
+
+from grafanalib import zabbix as Z
+from grafanalib import zabbix_eval
+
+FUNCTIONS = [
+    Z.ZabbixDeltaFunction(),
+    Z.ZabbixGroupByFunction(interval="5m", function="avg"),
+    Z.ZabbixScaleFunction(factor=8),
+    Z.ZabbixTopFunction(number=10, function="max"),
+    Z.ZabbixSetAliasByRegexFunction(regexp=r"host-\d+"),
+]
+
+
+def main(args):
+    points = int(args[0]) if args else 1440
+    times = np.arange(points) * 60
+    for count in (10, 100, 1000, 10000):
+        series = zabbix_eval.TimeSeries(
+            times=times,
+            values=np.cumsum(np.random.rand(count, points), axis=1),
+            names=['host-{} eth0 in'.format(i) for i in range(count)],
+        )
+        seconds = min(timeit.repeat(
+            lambda: zabbix_eval.apply_functions(FUNCTIONS, series),
+            number=1, repeat=3))
+        print('{:6} series {:8.4f}s {:10.0f} series/s'.format(
+            count, seconds, count / seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,366 @@
+"""A stand-in for Grafana's HTTP API, for tests and benchmarks.
+
+Implements the data source, plugin settings and dashboard endpoints that
+``gfdatasource`` and ``upload-dashboards`` use, keeping everything in memory.
+Responses can be slowed down, made to fail at random, and rate limited, to
+see how clients cope.
+
+Run it with::
+
+  $ python -m grafanalib._fake_grafana --port 3000 --latency 0.05 \\
+      --error-rate 0.01 --rate-limit 100
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+import attr
+
+from grafanalib._deploy import slugify
+
+# Settings that Grafana stores but never returns
+SECRET_KEYS = frozenset([
+    'password', 'basicAuthPassword', 'secureJsonData', 'secure_json_data'])
+
+
+@attr.s
+class FakeGrafanaStats(object):
+    """What a ``FakeGrafana`` has been asked to do.
+
+    :param requests: number of requests received
+    :param connections: number of connections accepted
+    :param errors: number of injected server errors
+    :param rateLimited: number of requests refused by the rate limit
+    :param compressed: number of requests with gzipped bodies
+    :param endpoints: a dict mapping ``"METHOD /path/pattern"`` to the
+        number of requests made to it
+    """
+
+    requests = attr.ib(default=0)
+    connections = attr.ib(default=0)
+    errors = attr.ib(default=0)
+    rateLimited = attr.ib(default=0)
+    compressed = attr.ib(default=0)
+    endpoints = attr.ib(default=attr.Factory(dict))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies are written separately, so without this the
+    # latency of each response includes a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, data, headers=()):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            with self.server.lock:
+                self.server.stats.compressed += 1
+            body = gzip.decompress(body)
+        return json.loads(body.decode('utf-8')) if body else None
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        body = self._body()
+        server = self.server
+        for route_method, pattern, handler in _ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            self._reply(404, {'message': 'Not found'})
+            return
+        endpoint = '{} {}'.format(method, pattern.pattern.strip('^$'))
+        outcome = server.admit(endpoint)
+        server.delay()
+        if outcome == 429:
+            self._reply(429, {'message': 'Too many requests'},
+                        headers=[('Retry-After', '1')])
+        elif outcome == 500:
+            self._reply(500, {'message': 'Injected error'})
+        else:
+            args = [unquote(group) for group in match.groups()]
+            with server.lock:
+                status, data = handler(server, body, parse_qs(url.query),
+                                       *args)
+            self._reply(status, data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+def _create_datasource(server, body, query):
+    if body['name'] in server.datasources:
+        return 409, {'message': 'Data source with same name already exists'}
+    server.next_id += 1
+    server.datasources[body['name']] = dict(body, id=server.next_id)
+    return 200, {'id': server.next_id, 'message': 'Datasource added'}
+
+
+def _get_datasource(server, body, query, name):
+    if name not in server.datasources:
+        return 404, {'message': 'Data source not found'}
+    return 200, {
+        key: value for key, value in server.datasources[name].items()
+        if key not in SECRET_KEYS
+    }
+
+
+def _update_datasource(server, body, query, id):
+    for name, data_source in list(server.datasources.items()):
+        if data_source['id'] == int(id):
+            del server.datasources[name]
+            server.datasources[body['name']] = dict(body, id=int(id))
+            return 200, {'message': 'Datasource updated'}
+    return 404, {'message': 'Data source not found'}
+
+
+def _get_plugin_settings(server, body, query, id):
+    if id not in server.plugins:
+        return 404, {'message': 'Plugin not found'}
+    return 200, {
+        key: value for key, value in server.plugins[id].items()
+        if key not in SECRET_KEYS
+    }
+
+
+def _update_plugin_settings(server, body, query, id):
+    if id not in server.plugins:
+        return 404, {'message': 'Plugin not installed'}
+    settings = {
+        'id': id,
+        'enabled': body.get('enabled', False),
+        'pinned': body.get('pinned', False),
+        'jsonData': body.get('jsonData', body.get('json_data')),
+    }
+    secure_json_data = body.get(
+        'secureJsonData', body.get('secure_json_data'))
+    if secure_json_data is not None:
+        settings['secureJsonData'] = secure_json_data
+    server.plugins[id] = settings
+    return 200, {'message': 'Plugin settings updated'}
+
+
+def _search(server, body, query):
+    tags = query.get('tag', [])
+    limit = int(query.get('limit', [1000])[0])
+    page = int(query.get('page', [1])[0])
+    results = [
+        {'uri': 'db/' + slug, 'title': dashboard.get('title'),
+         'tags': dashboard.get('tags', []), 'type': 'dash-db'}
+        for slug, dashboard in sorted(server.dashboards.items())
+        if all(tag in dashboard.get('tags', []) for tag in tags)
+    ]
+    return 200, results[(page - 1) * limit:page * limit]
+
+
+def _get_dashboard(server, body, query, slug):
+    if slug not in server.dashboards:
+        return 404, {'message': 'Dashboard not found'}
+    return 200, {'dashboard': server.dashboards[slug],
+                 'meta': {'slug': slug}}
+
+
+def _post_dashboard(server, body, query):
+    dashboard = body['dashboard']
+    slug = slugify(dashboard['title'])
+    existing = server.dashboards.get(slug)
+    if existing and not body.get('overwrite'):
+        return 412, {'status': 'name-exists',
+                     'message': 'A dashboard with the same name exists'}
+    if existing:
+        id, version = existing['id'], existing['version'] + 1
+    else:
+        server.next_id += 1
+        id, version = server.next_id, 1
+    server.dashboards[slug] = dict(dashboard, id=id, version=version)
+    return 200, {'slug': slug, 'status': 'success', 'version': version}
+
+
+def _delete_dashboard(server, body, query, slug):
+    if server.dashboards.pop(slug, None) is None:
+        return 404, {'message': 'Dashboard not found'}
+    return 200, {'title': slug}
+
+
+_ROUTES = [
+    (method, re.compile(pattern), handler)
+    for method, pattern, handler in [
+        ('POST', r'^/api/datasources$', _create_datasource),
+        ('GET', r'^/api/datasources/name/([^/]+)$', _get_datasource),
+        ('PUT', r'^/api/datasources/(\d+)$', _update_datasource),
+        ('GET', r'^/api/plugins/([^/]+)/settings$', _get_plugin_settings),
+        ('POST', r'^/api/plugins/([^/]+)/settings$',
+         _update_plugin_settings),
+        ('GET', r'^/api/search$', _search),
+        ('GET', r'^/api/dashboards/db/([^/]+)$', _get_dashboard),
+        ('POST', r'^/api/dashboards/db$', _post_dashboard),
+        ('DELETE', r'^/api/dashboards/db/([^/]+)$', _delete_dashboard),
+    ]
+]
+
+
+class FakeGrafana(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An in-memory stand-in for Grafana's HTTP API.
+
+    Use it as a context manager, which starts it in a background thread::
+
+        with FakeGrafana(latency=0.01, error_rate=0.1) as grafana:
+            client = GrafanaClient(grafana.url)
+
+    :param address: ``(host, port)`` to listen on. Port 0 picks a free port.
+    :param latency: how long to wait before each response, in seconds
+    :param jitter: a random extra wait of up to this many seconds
+    :param error_rate: the fraction of requests that fail with a 500
+    :param rate_limit: how many requests per second to allow before
+        responding with 429, or ``None`` for no limit
+    :param seed: seed for the random latency and errors
+    :param apps: ids of the app plugins that are installed
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 error_rate=0, rate_limit=None, seed=None, apps=()):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.stats = FakeGrafanaStats()
+        self.datasources = {}
+        self.plugins = {
+            id: {'id': id, 'enabled': False, 'pinned': False,
+                 'jsonData': None}
+            for id in apps
+        }
+        self.dashboards = {}
+        self.next_id = 0
+        self._random = random.Random(seed)
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def admit(self, endpoint):
+        """Decide how to answer a request.
+
+        :return: 429 if it is over the rate limit, 500 if it should fail,
+            or ``None`` to answer it
+        """
+        with self.lock:
+            self.stats.requests += 1
+            self.stats.endpoints[endpoint] = (
+                self.stats.endpoints.get(endpoint, 0) + 1)
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.rate_limit,
+                    self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.stats.rateLimited += 1
+                    return 429
+                self._tokens -= 1
+            if self._random.random() < self.error_rate:
+                self.stats.errors += 1
+                return 500
+        return None
+
+    def delay(self):
+        """Wait as long as a response should take."""
+        with self.lock:
+            wait = self.latency + self._random.uniform(0, self.jitter)
+        if wait:
+            time.sleep(wait)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='fake-grafana')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Seconds to wait before each response')
+    parser.add_argument(
+        '--jitter', type=float, default=0,
+        help='Up to this many extra seconds to wait, at random')
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Fraction of requests that fail with a 500')
+    parser.add_argument(
+        '--rate-limit', type=float, default=None,
+        help='Requests per second allowed before responding with 429')
+    opts = parser.parse_args(args)
+    server = FakeGrafana(
+        (opts.host, opts.port), latency=opts.latency, jitter=opts.jitter,
+        error_rate=opts.error_rate, rate_limit=opts.rate_limit)
+    print('Serving a fake Grafana at {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,36 @@
 """Generate JSON Grafana dashboards."""
 
 import argparse
+import contextlib
+import hashlib
+import io
 import json
 import os
+import queue
 import sys
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
 from importlib.machinery import SourceFileLoader
 
+import attr
+
 
 DASHBOARD_SUFFIX = '.dashboard.py'
 
+# Formats of single file outputs, by the extensions they are guessed from
+BUNDLE_FORMATS = {
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.tar': 'tar',
+    '.tar.gz': 'tar',
+    '.tgz': 'tar',
+    '.zip': 'zip',
+}
+ARCHIVE_INDEX = 'index.json'
+
 
 class DashboardError(Exception):
     """Raised when there is something wrong with a dashboard."""
@@ -47,15 +69,347 @@ def write_dashboard(dashboard, stream):
     stream.write('\n')
 
 
+def encode_dashboard(dashboard):
+    """Get the JSON of a dashboard, as ``write_dashboard`` writes it.
+
+    :return: UTF-8 encoded bytes
+    """
+    return (json.dumps(
+        dashboard.to_json_data(), sort_keys=True, indent=2,
+        cls=DashboardEncoder) + '\n').encode('utf-8')
+
+
 def print_dashboard(dashboard):
     write_dashboard(dashboard, stream=sys.stdout)
 
 
-def write_dashboards(paths):
+def _temp_path(path):
+    """Get a unique temporary path next to ``path``."""
+    return os.path.join(
+        os.path.dirname(path),
+        '.{}.{}.tmp'.format(os.path.basename(path), uuid.uuid4().hex))
+
+
+def _fsync_path(path, flags):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@attr.s
+class AtomicFileWriter(object):
+    """Writes files in a background thread, replacing each atomically.
+
+    Each file is first written to a temporary file next to it. When the
+    writer is closed, the temporary files are flushed to disk together and
+    then renamed over their destinations, so a crash never leaves a file
+    half written. If any write fails, or the writer is aborted, the
+    temporary files are removed instead.
+
+    Used as a context manager, it is closed at the end of the block, or
+    aborted if the block raises.
+
+    :param max_pending: how many files can wait to be written before
+        ``write`` blocks
+    :param fsync: defines if files are flushed to disk before being renamed
+    """
+
+    max_pending = attr.ib(default=64)
+    fsync = attr.ib(default=True)
+    _queue = attr.ib(init=False, repr=False)
+    _temps = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _error = attr.ib(default=None, init=False, repr=False)
+    _aborted = attr.ib(default=False, init=False, repr=False)
+    _thread = attr.ib(init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._queue = queue.Queue(self.max_pending)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None or self._aborted:
+                continue
+            path, data = item
+            temp = _temp_path(path)
+            try:
+                fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                self._temps.append((temp, path))
+                with os.fdopen(fd, 'wb') as temp_file:
+                    temp_file.write(data)
+            except Exception as e:
+                # Keep draining the queue, so that ``write`` doesn't block,
+                # and raise this from ``write`` or ``close``.
+                self._error = e
+
+    def write(self, path, data):
+        """Write ``data`` to ``path`` when the writer is closed.
+
+        :param data: bytes to write
+        :raise Exception: the error of an earlier write that failed, such as
+            an ``OSError``
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((path, data))
+
+    def _stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _discard(self):
+        for temp, _ in self._temps:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+
+    def abort(self):
+        """Stop writing, and remove the temporary files."""
+        self._aborted = True
+        self._stop()
+        self._discard()
+
+    def close(self):
+        """Wait for the pending writes, then replace the files.
+
+        :raise Exception: the error of the first write that failed, such as
+            an ``OSError``
+        """
+        self._stop()
+        try:
+            if self._error is not None:
+                raise self._error
+            if self.fsync:
+                for temp, _ in self._temps:
+                    _fsync_path(temp, os.O_WRONLY)
+            for temp, path in self._temps:
+                os.replace(temp, path)
+            if self.fsync and os.name == 'posix':
+                directories = set(
+                    os.path.dirname(path) for _, path in self._temps)
+                for directory in sorted(directories):
+                    _fsync_path(directory or '.', os.O_RDONLY)
+        except Exception:
+            self._discard()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def apply_query_budget(dashboard, budget, auto_refresh=False):
+    """Make sure ``dashboard`` stays within a query budget.
+
+    :param dashboard: A ``Dashboard``
+    :param budget: Maximum queries per minute per viewer, or ``None`` for no
+        budget.
+    :param bool auto_refresh: If true, slow down the dashboard's refresh
+        interval until it fits within the budget.
+    :raise DashboardError: if the dashboard exceeds its budget
+    :return: A ``Dashboard``, with a new refresh interval if
+        ``auto_refresh`` is set.
+    """
+    if budget is None:
+        return dashboard
+    if auto_refresh:
+        try:
+            return dashboard.auto_refresh(budget)
+        except ValueError as e:
+            raise DashboardError(str(e))
+    load = dashboard.query_load().per_minute()
+    if load > budget:
+        raise DashboardError(
+            "Dashboard {!r} makes {:g} queries per minute, more than its "
+            "budget of {}".format(dashboard.title, load, budget))
+    return dashboard
+
+
+def _generate(paths, query_budget, auto_refresh):
     for path in paths:
-        dashboard = load_dashboard(path)
-        with open(get_json_path(path), 'w') as json_file:
-            write_dashboard(dashboard, json_file)
+        yield path, apply_query_budget(
+            load_dashboard(path), query_budget, auto_refresh)
+
+
+def write_dashboards(paths, query_budget=None, auto_refresh=False):
+    """Write the JSON of dashboard definitions next to them.
+
+    Dashboards are written in the background while the next ones are
+    generated, and the JSON files are only replaced once all of them have
+    been written, atomically. If any dashboard fails, none are replaced.
+    """
+    with AtomicFileWriter() as writer:
+        for path, dashboard in _generate(paths, query_budget, auto_refresh):
+            writer.write(get_json_path(path), encode_dashboard(dashboard))
+
+
+def bundle_names(paths):
+    """Get the names of dashboards' JSON in a bundle.
+
+    These are the paths the JSON files would have, relative to the
+    directory that contains all of them.
+    """
+    json_paths = [get_json_path(path) for path in paths]
+    base = os.path.dirname(os.path.commonprefix(json_paths))
+    return [
+        os.path.relpath(path, base).replace(os.sep, '/')
+        for path in json_paths
+    ]
+
+
+def write_ndjson(dashboards, stream):
+    """Write dashboards as newline-delimited JSON.
+
+    Each line is an object with the ``path`` of the dashboard in the bundle,
+    and the ``dashboard`` itself.
+
+    :param dashboards: an iterable of ``(path, Dashboard)`` tuples
+    :param stream: a text stream to write to
+    """
+    for path, dashboard in dashboards:
+        stream.write(json.dumps(
+            {'path': path, 'dashboard': dashboard.to_json_data()},
+            sort_keys=True, separators=(',', ':'), cls=DashboardEncoder))
+        stream.write('\n')
+
+
+def _archive_entries(dashboards, index):
+    for path, dashboard in dashboards:
+        if path == ARCHIVE_INDEX:
+            raise DashboardError(
+                'A dashboard cannot be called {}, as that is the name of '
+                'the index'.format(ARCHIVE_INDEX))
+        data = encode_dashboard(dashboard)
+        index.append({
+            'path': path,
+            'title': dashboard.title,
+            'tags': dashboard.tags,
+            'sha1': hashlib.sha1(data).hexdigest(),
+        })
+        yield path, data
+
+
+def write_tar(dashboards, stream, compress=False):
+    """Write dashboards to a tar archive, with an index.
+
+    Each dashboard is stored as it would be written to a file. The archive
+    ends with ``index.json``, which lists the path, title, tags and SHA-1 of
+    each dashboard.
+
+    :param dashboards: an iterable of ``(path, Dashboard)`` tuples
+    :param stream: a binary stream to write to
+    :param compress: defines if the archive should be gzipped
+    """
+    index = []
+    now = time.time()
+    with tarfile.open(
+            fileobj=stream, mode='w:gz' if compress else 'w') as archive:
+        for path, data in _archive_entries(dashboards, index):
+            info = tarfile.TarInfo(path)
+            info.size, info.mtime, info.mode = len(data), now, 0o644
+            archive.addfile(info, io.BytesIO(data))
+        data = json.dumps({'dashboards': index}, sort_keys=True,
+                          indent=2).encode('utf-8')
+        info = tarfile.TarInfo(ARCHIVE_INDEX)
+        info.size, info.mtime, info.mode = len(data), now, 0o644
+        archive.addfile(info, io.BytesIO(data))
+
+
+def write_zip(dashboards, stream):
+    """Write dashboards to a zip archive, with an index.
+
+    The archive has the same contents as ``write_tar``'s.
+
+    :param stream: a seekable binary stream to write to
+    """
+    index = []
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, data in _archive_entries(dashboards, index):
+            archive.writestr(path, data)
+        archive.writestr(ARCHIVE_INDEX, json.dumps(
+            {'dashboards': index}, sort_keys=True, indent=2))
+
+
+@contextlib.contextmanager
+def _replacing(path):
+    """Open a temporary file, and rename it over ``path`` when done.
+
+    The file is removed instead if the block raises.
+    """
+    temp = _temp_path(path)
+    try:
+        with open(temp, 'wb') as output:
+            yield output
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def bundle_format(output):
+    """Guess the format of a bundle from its file name.
+
+    :raise DashboardError: if the format can't be guessed
+    """
+    if output == '-':
+        return 'ndjson'
+    for extension, format in sorted(BUNDLE_FORMATS.items()):
+        if output.endswith(extension):
+            return format
+    raise DashboardError(
+        "Can't tell the format of {} from its extension. Use one of {}, "
+        "or --format".format(output, ', '.join(sorted(BUNDLE_FORMATS))))
+
+
+def bundle_dashboards(paths, output, format=None, query_budget=None,
+                      auto_refresh=False):
+    """Write the JSON of dashboard definitions to a single file.
+
+    Files are replaced atomically, and only once all dashboards have been
+    generated. Dashboards are generated as they are written.
+
+    :param output: path of the bundle, or ``-`` for NDJSON on stdout
+    :param format: ``ndjson``, ``tar`` or ``zip``. Defaults to guessing it
+        from the extension of ``output``. Tar archives whose name ends in
+        ``gz`` are gzipped.
+    """
+    format = format or bundle_format(output)
+    dashboards = zip(
+        bundle_names(paths), (
+            dashboard for _, dashboard
+            in _generate(paths, query_budget, auto_refresh)))
+    if output == '-':
+        if format != 'ndjson':
+            raise DashboardError(
+                'Only NDJSON can be written to stdout, not {}'.format(format))
+        write_ndjson(dashboards, sys.stdout)
+        return
+    with _replacing(output) as stream:
+        if format == 'ndjson':
+            text = io.TextIOWrapper(stream, encoding='utf-8')
+            write_ndjson(dashboards, text)
+            text.flush()
+            text.detach()
+        elif format == 'tar':
+            write_tar(dashboards, stream, compress=output.endswith('gz'))
+        else:
+            write_zip(dashboards, stream)
 
 
 def get_json_path(path):
@@ -79,9 +433,41 @@ def generate_dashboards(args):
         'dashboards', metavar='DASHBOARD', type=os.path.abspath,
         nargs='+', help='Path to dashboard definition',
     )
+    parser.add_argument(
+        '--query-budget', type=float, default=None,
+        help='Fail if a dashboard makes more than this many queries per '
+        'minute per viewer',
+    )
+    parser.add_argument(
+        '--auto-refresh', action='store_true',
+        help='Instead of failing, slow down the refresh interval of '
+        'dashboards that go over the query budget. Needs --query-budget',
+    )
+    parser.add_argument(
+        '--output', '-o', type=str, default=None,
+        help='Write all dashboards to this one file, rather than each next '
+        'to its definition. Use - for NDJSON on stdout',
+    )
+    parser.add_argument(
+        '--format', choices=sorted(set(BUNDLE_FORMATS.values())),
+        help='Format of --output: NDJSON, or a tar or zip archive with an '
+        'index. Defaults to guessing it from the extension',
+    )
     opts = parser.parse_args(args)
+    if opts.format and not opts.output:
+        parser.error('--format needs --output')
+    if opts.auto_refresh and opts.query_budget is None:
+        parser.error('--auto-refresh needs --query-budget')
     try:
-        write_dashboards(opts.dashboards)
+        if opts.output:
+            bundle_dashboards(
+                opts.dashboards, opts.output, format=opts.format,
+                query_budget=opts.query_budget,
+                auto_refresh=opts.auto_refresh)
+        else:
+            write_dashboards(
+                opts.dashboards, query_budget=opts.query_budget,
+                auto_refresh=opts.auto_refresh)
     except DashboardError as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
@@ -104,8 +490,8 @@ def generate_dashboard(args):
         if not opts.output:
             print_dashboard(dashboard)
         else:
-            with open(opts.output, 'w') as output:
-                write_dashboard(dashboard, output)
+            with AtomicFileWriter() as writer:
+                writer.write(opts.output, encode_dashboard(dashboard))
     except DashboardError as e:
         sys.stderr.write('ERROR: {}\n'.format(e))
         return 1
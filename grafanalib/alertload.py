@@ -0,0 +1,207 @@
+"""Estimate and spread the load that alerts put on data sources.
+
+Grafana evaluates each alert whenever the Unix time is a multiple of the
+alert's ``frequency``, and every ``AlertCondition`` runs its query over its
+``TimeRange`` each time. Hundreds of alerts with the default ``"60s"``
+frequency therefore all hit their data sources in the same second of every
+minute.
+"""
+
+import attr
+
+import grafanalib.core as G
+
+
+def _range_seconds(time_range):
+    """How many seconds of data a condition reads each evaluation."""
+    def seconds(value):
+        return 0 if value == 'now' else G.interval_to_seconds(value)
+    return abs(seconds(time_range.from_time) - seconds(time_range.to_time))
+
+
+def _iter_alerts(dashboards):
+    """Yield ``(data_source, alert)`` for every alert on the dashboards."""
+    for dashboard in dashboards:
+        for panel in dashboard._iter_panels():
+            alert = getattr(panel, 'alert', None)
+            if alert:
+                yield panel.dataSource, alert
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+@attr.s
+class AlertLoad(object):
+    """The load that a set of alerts puts on their data sources.
+
+    :param alerts: number of alerts
+    :param conditions: number of alert conditions, i.e. queries per round of
+        evaluations
+    :param queriesPerSecond: average number of queries per second
+    :param rangeSecondsPerSecond: seconds of data read by queries, per
+        second
+    :param peakQueries: queries started in the busiest second. Every so
+        often all schedules line up, so this is mostly the total number of
+        conditions; ``p99Queries`` shows the typical spikes.
+    :param p99Queries: queries started in all but the busiest 1% of seconds
+    :param dataSources: A dict mapping each data source to the average
+        number of queries it gets per second
+    """
+
+    alerts = attr.ib()
+    conditions = attr.ib()
+    queriesPerSecond = attr.ib()
+    rangeSecondsPerSecond = attr.ib()
+    peakQueries = attr.ib()
+    p99Queries = attr.ib()
+    dataSources = attr.ib(default=attr.Factory(dict))
+
+
+def alert_load(dashboards, horizon=3600):
+    """Estimate the load of all the alerts on some dashboards.
+
+    :param dashboards: A list of ``Dashboard`` objects
+    :param horizon: How many seconds of evaluations to look at for the peak
+        load. Should be a multiple of the alerts' frequencies.
+    :return: An ``AlertLoad``
+    """
+    alerts = conditions = 0
+    qps = range_per_second = 0.0
+    data_sources = {}
+    schedule = [0] * horizon
+    for data_source, alert in _iter_alerts(dashboards):
+        frequency = int(G.interval_to_seconds(alert.frequency))
+        queries = len(alert.alertConditions)
+        alerts += 1
+        conditions += queries
+        qps += queries / frequency
+        range_per_second += sum(
+            _range_seconds(condition.timeRange)
+            for condition in alert.alertConditions) / frequency
+        data_sources[data_source] = (
+            data_sources.get(data_source, 0) + queries / frequency)
+        for second in range(0, horizon, frequency):
+            schedule[second] += queries
+    return AlertLoad(
+        alerts=alerts,
+        conditions=conditions,
+        queriesPerSecond=qps,
+        rangeSecondsPerSecond=range_per_second,
+        peakQueries=max(schedule),
+        p99Queries=_percentile(schedule, 99),
+        dataSources=data_sources,
+    )
+
+
+def _same_query(a, b):
+    return (a.target == b.target and a.timeRange == b.timeRange and
+            a.reducerType == b.reducerType)
+
+
+def _merge_pair(a, b, operator):
+    """Merge two conditions on the same query into one, if possible.
+
+    Grafana checks each condition against every series of its query, and it
+    holds if any series matches. So ``GreaterThan(hi) OR LowerThan(lo)`` is
+    ``OutsideRange(lo, hi)``: both hold when some series is outside the
+    range. ``AND`` can't be merged into a ``WithinRange``, as each bound can
+    be met by a different series.
+    """
+    if operator != G.OP_OR:
+        return None
+    bounds = {a.evaluator.type: a.evaluator.params,
+              b.evaluator.type: b.evaluator.params}
+    if set(bounds) != {G.EVAL_GT, G.EVAL_LT}:
+        return None
+    upper, lower = bounds[G.EVAL_GT][0], bounds[G.EVAL_LT][0]
+    if lower < upper:
+        return attr.assoc(a, evaluator=G.OutsideRange(lower, upper))
+    return None
+
+
+def merge_conditions(alert):
+    """Merge the conditions of an alert that run the same query.
+
+    Conditions with the same target, time range and reducer are merged when
+    the result is the same: duplicates are dropped, and a ``GreaterThan``
+    and a lower ``LowerThan`` joined by ``OP_OR`` become an
+    ``OutsideRange``. Grafana combines conditions in order, so this is only
+    done for alerts whose conditions all use the same operator.
+
+    :return: A new ``Alert`` with the merged conditions
+    """
+    remaining = list(alert.alertConditions)
+    operators = set(condition.operator for condition in remaining[1:])
+    if len(operators) > 1:
+        return alert
+    operator = operators.pop() if operators else G.OP_AND
+    merged = []
+    while remaining:
+        condition = remaining.pop(0)
+        remaining = [
+            other for other in remaining
+            if not (_same_query(condition, other) and
+                    condition.evaluator == other.evaluator)
+        ]
+        for other in list(remaining):
+            if not _same_query(condition, other):
+                continue
+            combined = _merge_pair(condition, other, operator)
+            if combined is not None:
+                condition = combined
+                remaining.remove(other)
+        merged.append(condition)
+    if merged:
+        merged[0] = attr.assoc(
+            merged[0], operator=alert.alertConditions[0].operator)
+    return attr.assoc(alert, alertConditions=merged)
+
+
+def _spread(frequency, count, jitter):
+    """Pick ``count`` frequencies close to ``frequency``.
+
+    Frequencies are taken in the order ``f, f + 1, f - 1, f + 2, ...``
+    seconds, staying within ``jitter`` of ``f``, and then reused round robin.
+    """
+    width = int(frequency * jitter)
+    choices = [frequency]
+    for step in range(1, width + 1):
+        choices.extend([frequency + step, frequency - step])
+    return [choices[i % len(choices)] for i in range(count)]
+
+
+def stagger_alerts(dashboards, jitter=0.1):
+    """Flatten the load of all the alerts on some dashboards.
+
+    Conditions are merged with ``merge_conditions``. Then alerts that share
+    a frequency are given slightly different frequencies, so that they stop
+    running in the same second: Grafana has no per-alert offset, so spreading
+    the frequencies is how their evaluations are offset from each other.
+
+    :param dashboards: A list of ``Dashboard`` objects
+    :param jitter: The largest change to an alert's frequency, as a fraction
+        of it. 0.1 lets a ``"60s"`` alert run every 54 to 66 seconds.
+    :return: A list of new ``Dashboard`` objects, in the same order
+    """
+    by_frequency = {}
+    for _, alert in _iter_alerts(dashboards):
+        frequency = int(G.interval_to_seconds(alert.frequency))
+        by_frequency[frequency] = by_frequency.get(frequency, 0) + 1
+    assigned = {
+        frequency: iter(_spread(frequency, count, jitter))
+        for frequency, count in by_frequency.items()
+    }
+
+    def stagger(panel):
+        alert = getattr(panel, 'alert', None)
+        if not alert:
+            return panel
+        frequency = int(G.interval_to_seconds(alert.frequency))
+        alert = merge_conditions(alert)
+        alert = attr.assoc(
+            alert, frequency='{}s'.format(next(assigned[frequency])))
+        return attr.assoc(panel, alert=alert)
+    return [dashboard._map_panels(stagger) for dashboard in dashboards]
@@ -0,0 +1,369 @@
+"""Offline simulation of Grafana alerts over recorded data.
+
+Backtest ``Alert`` definitions before Grafana runs them for real. Recorded
+series are loaded from CSV or NumPy ``.npz`` files, and every alert is
+evaluated at each tick of its ``frequency`` the way Grafana's alerting engine
+would: each ``AlertCondition`` reduces the points in its ``TimeRange`` with
+its reducer, checks the result with its ``Evaluator``, and the conditions are
+combined in order with their operators.
+
+Requires NumPy.
+"""
+
+import csv
+import json
+import time
+import warnings
+
+import attr
+import numpy as np
+
+import grafanalib.core as G
+from grafanalib._gen import DashboardEncoder
+
+# Most points gathered into windows at once when computing medians
+MAX_WINDOW_POINTS = 1 << 20
+
+
+def _as_2d(values):
+    values = np.asarray(values, dtype=float)
+    return values.reshape(1, -1) if values.ndim == 1 else values
+
+
+@attr.s
+class Series(object):
+    """Recorded values of all the series returned by one query.
+
+    :param times: ascending Unix timestamps, in seconds
+    :param values: an array with one row per series and one column per
+        timestamp. Missing points are NaN.
+    """
+
+    times = attr.ib(convert=lambda times: np.asarray(times, dtype=float))
+    values = attr.ib(convert=_as_2d)
+
+    @values.validator
+    def _check_shape(self, attribute, values):
+        if values.shape[1] != len(self.times):
+            raise ValueError(
+                "{} has {} points, but there are {} timestamps".format(
+                    attribute.name, values.shape[1], len(self.times)))
+
+
+def load_csv(path):
+    """Load recorded series from a CSV file.
+
+    The first column holds timestamps. Every other column holds a series,
+    and is named after the query that returns it, optionally followed by a
+    colon and a series name, e.g. ``A:eu-west-1``. Queries can be named by
+    ``refId`` or by expression; see ``Simulator``. As colons separate series
+    names, expressions with colons can only be loaded from ``.npz`` files.
+    Empty cells are missing points.
+
+    :return: A dict mapping query names to ``Series``
+    """
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        rows = [[float(cell) if cell else np.nan for cell in row]
+                for row in reader]
+    data = np.array(rows, dtype=float).reshape(-1, len(header))
+    columns = {}
+    for i, name in enumerate(header[1:], 1):
+        columns.setdefault(name.split(':', 1)[0], []).append(data[:, i])
+    return {
+        ref_id: Series(times=data[:, 0], values=np.vstack(values))
+        for ref_id, values in columns.items()
+    }
+
+
+def load_npz(path):
+    """Load recorded series from a NumPy ``.npz`` file.
+
+    The file holds an array of timestamps named ``time``, and for each
+    query an array with one row per series, named by ``refId`` or by
+    expression.
+
+    :return: A dict mapping query names to ``Series``
+    """
+    with np.load(path) as data:
+        times = data['time']
+        return {
+            name: Series(times=times, values=data[name])
+            for name in data.files if name != 'time'
+        }
+
+
+def load_series(path):
+    """Load recorded series from a ``.csv`` or ``.npz`` file."""
+    if path.endswith('.npz'):
+        return load_npz(path)
+    return load_csv(path)
+
+
+def _relative_seconds(value):
+    """Convert the ends of a ``TimeRange`` to seconds before now."""
+    return 0 if value == 'now' else G.interval_to_seconds(value)
+
+
+def query_key(target, dataSource=None):
+    """Identify the query a target runs, whatever its ``refId``.
+
+    :return: A tuple of the data source and the target's expression, or its
+        JSON without the ``refId`` for targets that have no expression
+    """
+    query = getattr(target, 'expr', None)
+    if query is None:
+        data = dict(target.to_json_data())
+        data.pop('refId', None)
+        query = json.dumps(data, sort_keys=True, cls=DashboardEncoder)
+    return dataSource, query
+
+
+def _window(values, lo, hi):
+    """Gather the points in [lo, hi) for each evaluation, padded with NaN."""
+    width = int((hi - lo).max()) if len(lo) else 0
+    index = lo[:, np.newaxis] + np.arange(width)
+    window = values[:, np.minimum(index, values.shape[1] - 1)]
+    window[:, index >= hi[:, np.newaxis]] = np.nan
+    return window
+
+
+def _median(values, lo, hi):
+    """Median of [lo, hi), gathering at most ``MAX_WINDOW_POINTS`` at once."""
+    width = int((hi - lo).max()) if len(lo) else 0
+    chunk = max(1, MAX_WINDOW_POINTS // max(1, width * len(values)))
+    parts = [
+        np.nanmedian(_window(values, lo[i:i + chunk], hi[i:i + chunk]),
+                     axis=2)
+        for i in range(0, len(lo), chunk)
+    ]
+    return np.hstack(parts) if parts else np.empty((len(values), 0))
+
+
+def _extreme(ufunc, values, lo, hi):
+    """Reduce [lo, hi) with ``np.fmin`` or ``np.fmax``.
+
+    Each window is covered by two overlapping power-of-two blocks, whose
+    extremes are built up one size at a time, so memory stays proportional
+    to the length of the series, however wide the windows.
+    """
+    result = np.full((len(values), len(lo)), np.nan)
+    width = hi - lo
+    nonempty = width > 0
+    if not nonempty.any():
+        return result
+    level = np.zeros(len(lo), dtype=int)
+    level[nonempty] = np.floor(np.log2(width[nonempty])).astype(int)
+    for row, blocks in zip(result, values):
+        for k in range(level.max() + 1):
+            if k:
+                # blocks[i] now covers [i, i + 2 ** k)
+                step = 1 << (k - 1)
+                blocks = ufunc(blocks[:-step], blocks[step:])
+            at = nonempty & (level == k)
+            if at.any():
+                row[at] = ufunc(blocks[lo[at]], blocks[hi[at] - (1 << k)])
+    return result
+
+
+def _last(values, lo, hi):
+    """Last point in [lo, hi) that isn't missing."""
+    positions = np.where(
+        np.isnan(values), -1, np.arange(values.shape[1]))
+    latest = np.maximum.accumulate(positions, axis=1)
+    index = latest[:, np.maximum(hi - 1, 0)]
+    found = (hi > lo) & (index >= lo)
+    return np.where(
+        found, np.take_along_axis(values, np.maximum(index, 0), axis=1),
+        np.nan)
+
+
+def _reduce(reducer, values, lo, hi):
+    """Reduce the points in [lo, hi) of every series, for each evaluation.
+
+    :return: An array with one row per series and one column per evaluation.
+        Evaluations without any points are NaN, except for ``count``.
+    """
+    present = ~np.isnan(values)
+    zero = np.zeros((values.shape[0], 1))
+    counts = np.hstack([zero, np.cumsum(present, axis=1)])
+    count = counts[:, hi] - counts[:, lo]
+    if reducer == G.RTYPE_COUNT:
+        return count
+    if reducer in (G.RTYPE_SUM, G.RTYPE_AVG):
+        sums = np.hstack([zero, np.cumsum(np.where(present, values, 0),
+                                          axis=1)])
+        total = sums[:, hi] - sums[:, lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = total if reducer == G.RTYPE_SUM else total / count
+    elif reducer == G.RTYPE_MIN:
+        result = _extreme(np.fmin, values, lo, hi)
+    elif reducer == G.RTYPE_MAX:
+        result = _extreme(np.fmax, values, lo, hi)
+    elif reducer == G.RTYPE_LAST:
+        result = _last(values, lo, hi)
+    elif reducer == G.RTYPE_MEDIAN:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = _median(values, lo, hi)
+    else:
+        raise ValueError("Unknown reducer: {!r}".format(reducer))
+    return np.where(count > 0, result, np.nan)
+
+
+def _evaluate(evaluator, reduced):
+    """Check reduced values against an ``Evaluator``."""
+    params = evaluator.params
+    with np.errstate(invalid='ignore'):
+        if evaluator.type == G.EVAL_GT:
+            return reduced > params[0]
+        if evaluator.type == G.EVAL_LT:
+            return reduced < params[0]
+        if evaluator.type == G.EVAL_WITHIN_RANGE:
+            lower, upper = sorted(params)
+            return (lower < reduced) & (reduced < upper)
+        if evaluator.type == G.EVAL_OUTSIDE_RANGE:
+            lower, upper = sorted(params)
+            return (reduced < lower) | (upper < reduced)
+    if evaluator.type == G.EVAL_NO_VALUE:
+        return np.isnan(reduced)
+    raise ValueError("Unknown evaluator: {!r}".format(evaluator.type))
+
+
+@attr.s
+class AlertSimulation(object):
+    """The result of simulating an alert.
+
+    :param alert: the simulated ``Alert``
+    :param times: the times at which the alert was evaluated
+    :param firing: for each evaluation, whether the alert fired
+    :param runtime: how long the simulation took, in seconds
+    """
+
+    alert = attr.ib()
+    times = attr.ib()
+    firing = attr.ib()
+    runtime = attr.ib()
+
+    @property
+    def flaps(self):
+        """How many times the alert changed state."""
+        return int(np.count_nonzero(self.firing[1:] != self.firing[:-1]))
+
+    def intervals(self):
+        """List the periods during which the alert was firing.
+
+        :return: A list of ``(start, end)`` tuples, where ``start`` is the
+            first evaluation that fired and ``end`` the first one after that
+            didn't, or ``None`` if the alert was still firing at the end.
+        """
+        changes = np.flatnonzero(
+            np.diff(np.concatenate([[0], self.firing.astype(int), [0]])))
+        starts, ends = changes[::2], changes[1::2]
+        return [
+            (self.times[start],
+             self.times[end] if end < len(self.times) else None)
+            for start, end in zip(starts, ends)
+        ]
+
+
+@attr.s
+class Simulator(object):
+    """Simulates alerts over recorded series.
+
+    Reduced values are cached, so alerts that share queries, time ranges,
+    reducers and frequencies only pay for them once.
+
+    The series for an alert condition are looked up by its target's
+    ``query_key``, then by the query alone (the target's ``expr``, for
+    Prometheus targets), and only then by its ``refId``. Most alerts query
+    ``refId`` ``"A"``, so key series by query to simulate many alerts at
+    once.
+
+    :param series: A dict mapping queries to the ``Series`` they return.
+        See ``load_series``.
+    """
+
+    series = attr.ib()
+    _reduced = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def _eval_times(self, frequency, lookback):
+        times = [series.times for series in self.series.values()]
+        start = min(t[0] for t in times) + lookback
+        end = max(t[-1] for t in times)
+        return np.arange(start, end + 1, G.interval_to_seconds(frequency))
+
+    def _series_key(self, target, dataSource):
+        key = query_key(target, dataSource)
+        for candidate in (key, key[1], target.refId):
+            if candidate in self.series:
+                return candidate
+        raise KeyError(
+            "No series recorded for query {!r} ({!r})".format(
+                key[1], target.refId))
+
+    def _condition(self, condition, times, dataSource):
+        series_key = self._series_key(condition.target, dataSource)
+        key = (series_key, condition.timeRange.from_time,
+               condition.timeRange.to_time, condition.reducerType,
+               times[0], times[-1], len(times))
+        reduced = self._reduced.get(key)
+        if reduced is None:
+            series = self.series[series_key]
+            start = times - _relative_seconds(condition.timeRange.from_time)
+            end = times - _relative_seconds(condition.timeRange.to_time)
+            lo = np.searchsorted(series.times, start, side='right')
+            hi = np.searchsorted(series.times, end, side='right')
+            reduced = _reduce(condition.reducerType, series.values, lo, hi)
+            self._reduced[key] = reduced
+        return _evaluate(condition.evaluator, reduced).any(axis=0)
+
+    def run(self, alert, dataSource=None):
+        """Simulate one ``Alert``.
+
+        Evaluation starts once the longest of its conditions' time ranges is
+        covered by the recorded data, so if the data is shorter than that,
+        the alert is never evaluated. Conditions without any data are
+        treated as not firing, whatever the alert's ``noDataState``.
+
+        :param dataSource: the data source of the alert's panel, used to
+            find its series
+        :return: An ``AlertSimulation``
+        """
+        started = time.time()
+        lookback = max(
+            _relative_seconds(condition.timeRange.from_time)
+            for condition in alert.alertConditions)
+        times = self._eval_times(alert.frequency, lookback)
+        if not len(times):
+            return AlertSimulation(
+                alert=alert, times=times, firing=np.zeros(0, dtype=bool),
+                runtime=time.time() - started)
+        firing = None
+        for condition in alert.alertConditions:
+            result = self._condition(condition, times, dataSource)
+            if firing is None:
+                firing = result
+            elif condition.operator == G.OP_OR:
+                firing = firing | result
+            else:
+                firing = firing & result
+        return AlertSimulation(
+            alert=alert, times=times, firing=firing,
+            runtime=time.time() - started)
+
+    def run_all(self, alerts, dataSource=None):
+        """Simulate many alerts.
+
+        :return: A list of ``AlertSimulation``, one for each alert
+        """
+        return [self.run(alert, dataSource) for alert in alerts]
+
+
+def dashboard_alerts(dashboard):
+    """List the alerts defined on a dashboard's panels."""
+    return [
+        panel.alert for panel in dashboard._iter_panels()
+        if getattr(panel, 'alert', None)
+    ]
@@ -0,0 +1,267 @@
+"""Build panels, alerts and targets in bulk from inventories.
+
+Generating a dashboard per service, or a graph per host, usually means
+calling ``weave.QPSGraph`` or ``zabbixMetricTarget`` once per row of an
+inventory. The functions here take the whole inventory at once, as columns,
+and describe each object with format strings, e.g. ``"{service} QPS"``,
+that are filled in from the columns of each row.
+
+Inventories can be given as a dict mapping column names to lists or NumPy
+arrays, or as an iterable of dicts such as a ``csv.DictReader``.
+
+Columns are checked once, up front, so that a bad value is reported with the
+column it came from rather than by the validators of whichever object it ends
+up in. Each object gets its own copy of the settings shared by every row,
+such as axes and tooltips, so changing one object doesn't change the others.
+"""
+
+import copy
+from numbers import Number
+import string
+
+import attr
+
+import grafanalib.core as G
+from grafanalib import weave
+from grafanalib import zabbix
+
+
+def _to_list(values):
+    tolist = getattr(values, 'tolist', None)
+    return tolist() if tolist else list(values)
+
+
+def _rows(inventory):
+    """Turn an inventory into a list of dicts, one per row."""
+    if hasattr(inventory, 'keys'):
+        names = list(inventory.keys())
+        columns = [_to_list(inventory[name]) for name in names]
+        lengths = set(len(column) for column in columns)
+        if len(lengths) > 1:
+            raise ValueError(
+                "Columns have different lengths: {}".format(
+                    dict(zip(names, map(len, columns)))))
+        return [dict(zip(names, values)) for values in zip(*columns)]
+    return [dict(row) for row in inventory]
+
+
+def _fields(template):
+    return set(
+        name for _, name, _, _ in string.Formatter().parse(template) if name)
+
+
+def _render(template, rows):
+    """Fill in a format string for every row.
+
+    Templates without any fields are shared by every row.
+    """
+    if not isinstance(template, str):
+        return [template] * len(rows)
+    fields = _fields(template)
+    if not fields:
+        return [template] * len(rows)
+    missing = fields - set(rows[0]) if rows else set()
+    if missing:
+        raise ValueError(
+            "Template {!r} refers to unknown columns: {}".format(
+                template, ', '.join(sorted(missing))))
+    return [template.format_map(row) for row in rows]
+
+
+def _numbers(value, rows, name):
+    """Get a number for every row, either a constant or from a column."""
+    if not isinstance(value, str):
+        if not isinstance(value, Number):
+            raise ValueError("{} should be a number or a column name".format(
+                name))
+        return [value] * len(rows)
+    try:
+        return [float(row[value]) for row in rows]
+    except KeyError:
+        raise ValueError("{} refers to unknown column {!r}".format(
+            name, value))
+    except (TypeError, ValueError):
+        raise ValueError("Column {!r} should only hold numbers".format(value))
+
+
+# Settings that can be shared rather than copied
+_IMMUTABLE = (str, Number, bool, type(None), tuple, frozenset)
+
+
+def _copy(value):
+    """Copy the dicts, lists and attrs objects in a setting.
+
+    Much faster than ``copy.deepcopy`` for the plain settings passed to
+    panels and targets.
+    """
+    if isinstance(value, _IMMUTABLE):
+        return value
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if attr.has(type(value)):
+        copied = object.__new__(type(value))
+        copied.__dict__ = {
+            key: _copy(item) for key, item in vars(value).items()}
+        return copied
+    return copy.deepcopy(value)
+
+
+def _build(make, count, shared):
+    """Call ``make(i, shared)`` for each row.
+
+    :param shared: A dict of settings shared by every row, which each call
+        gets its own copy of
+    """
+    return [make(i, _copy(shared)) for i in range(count)]
+
+
+def prom_graphs(inventory, data_source, title, expressions, **kwargs):
+    """Create a graph of Prometheus data for every row of an inventory.
+
+    :param inventory: Columns to fill in the templates from
+    :param str data_source: The name of the data source that provides
+        Prometheus data.
+    :param title: Template for the title of each graph
+    :param expressions: List of tuples of (legend, expr) templates
+    :param kwargs: Passed on to every ``Graph``
+    :return: A list of ``Graph`` objects, one per row
+    """
+    rows = _rows(inventory)
+    letters = string.ascii_uppercase
+    expressions = list(expressions)
+    if len(expressions) > len(letters):
+        raise ValueError(
+            'Too many expressions. Can support at most {}, but got {}'.format(
+                len(letters), len(expressions)))
+    titles = _render(title, rows)
+    columns = [
+        (_render(legend, rows), _render(expr, rows), refId)
+        for ((legend, expr), refId) in zip(expressions, letters)
+    ]
+    if 'yAxes' in kwargs:
+        kwargs['yAxes'] = G.to_y_axes(kwargs['yAxes'])
+
+    def make(i, shared):
+        return G.Graph(
+            title=titles[i],
+            dataSource=data_source,
+            targets=[
+                G.Target(exprs[i], legends[i], refId=refId)
+                for (legends, exprs, refId) in columns
+            ],
+            **shared
+        )
+    return _build(make, len(rows), kwargs)
+
+
+def qps_graphs(inventory, data_source, title, expressions, **kwargs):
+    """Create a QPS graph, as per ``weave.QPSGraph``, for every row.
+
+    :param inventory: Columns to fill in the templates from
+    :param str data_source: The name of the Prometheus data source
+    :param title: Template for the title of each graph
+    :param expressions: List of 5 or 7 templates of Prometheus expressions
+    :param kwargs: Passed on to every ``Graph``
+    :return: A list of ``Graph`` objects, one per row
+    """
+    if len(expressions) != 5 and len(expressions) != 7:
+        raise ValueError('Expected 5 or 7 expressions, got {}: {}'.format(
+            len(expressions), expressions))
+    legends = sorted(weave.ALIAS_COLORS.keys())
+    return prom_graphs(
+        inventory,
+        data_source=data_source,
+        title=title,
+        expressions=list(zip(legends, expressions)),
+        aliasColors=weave.ALIAS_COLORS,
+        yAxes=G.YAxes(
+            G.YAxis(format=G.OPS_FORMAT),
+            G.YAxis(format=G.SHORT_FORMAT),
+        ),
+        lineWidth=0,
+        nullPointMode=G.NULL_AS_ZERO,
+        stack=True,
+        fill=10,
+        tooltip=G.Tooltip(valueType=G.INDIVIDUAL),
+        **kwargs
+    )
+
+
+def alerts(inventory, name, message, expr, threshold,
+           evaluator=G.GreaterThan, reducerType=G.RTYPE_AVG,
+           timeRange=G.TimeRange("5m", "now"), operator=G.OP_AND,
+           refId='A', **kwargs):
+    """Create a single-condition alert for every row of an inventory.
+
+    :param inventory: Columns to fill in the templates from
+    :param name: Template for the name of each alert
+    :param message: Template for the message of each alert
+    :param expr: Template for the Prometheus expression to alert on
+    :param threshold: A number, or the name of a column of numbers, to pass
+        to ``evaluator``
+    :param evaluator: A function that makes an ``Evaluator`` from the
+        threshold, e.g. ``GreaterThan`` or ``LowerThan``
+    :param reducerType: RTYPE_*, used by all conditions
+    :param timeRange: ``TimeRange``, copied into every condition
+    :param operator: OP_*, used by all conditions
+    :param refId: target reference id
+    :param kwargs: Passed on to every ``Alert``
+    :return: A list of ``Alert`` objects, one per row
+    """
+    rows = _rows(inventory)
+    names = _render(name, rows)
+    messages = _render(message, rows)
+    exprs = _render(expr, rows)
+    thresholds = _numbers(threshold, rows, 'threshold')
+
+    def make(i, shared):
+        return G.Alert(
+            name=names[i],
+            message=messages[i],
+            alertConditions=[
+                G.AlertCondition(
+                    target=G.Target(expr=exprs[i], refId=refId),
+                    evaluator=evaluator(thresholds[i]),
+                    timeRange=shared.pop('timeRange'),
+                    operator=operator,
+                    reducerType=reducerType,
+                ),
+            ],
+            **shared
+        )
+    return _build(make, len(rows), dict(kwargs, timeRange=timeRange))
+
+
+def zabbix_metric_targets(inventory, application, group, host, item,
+                          functions=()):
+    """Create a ``zabbixMetricTarget`` for every row of an inventory.
+
+    :param inventory: Columns to fill in the templates from
+    :param application: Template for the Zabbix application
+    :param group: Template for the Zabbix host group
+    :param host: Template for the host name
+    :param item: Template for the item regexp
+    :param functions: Zabbix functions, copied into every target
+    :return: A list of ``ZabbixTarget`` objects, one per row
+    """
+    rows = _rows(inventory)
+    applications, groups, hosts, items = columns = [
+        _render(template, rows)
+        for template in (application, group, host, item)
+    ]
+    for values in columns:
+        if not all(isinstance(value, str) for value in values):
+            raise ValueError("Zabbix fields should be strings")
+
+    def make(i, shared):
+        return zabbix.ZabbixTarget(
+            mode=zabbix.ZABBIX_QMODE_METRICS,
+            application=applications[i],
+            group=groups[i],
+            host=hosts[i],
+            item=items[i],
+            **shared
+        )
+    return _build(make, len(rows), {'functions': list(functions)})
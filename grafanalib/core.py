@@ -10,8 +10,11 @@ from attr.validators import instance_of
 import itertools
 import math
 from numbers import Number
+import re
 import warnings
 
+from grafanalib.validators import is_in
+
 
 @attr.s
 class RGBA(object):
@@ -133,6 +136,67 @@ TEXT_MODE_MARKDOWN = "markdown"
 TEXT_MODE_HTML = "html"
 TEXT_MODE_TEXT = "text"
 
+# Seconds per unit of a Grafana interval, e.g. "10s", "5m" or "1d"
+INTERVAL_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'M': 30 * 24 * 60 * 60,
+    'y': 365 * 24 * 60 * 60,
+    'Y': 365 * 24 * 60 * 60,
+}
+
+
+def interval_to_seconds(interval):
+    """Convert a Grafana interval, such as ``"10s"`` or ``"1h"``, to seconds.
+
+    Numbers are taken to already be in seconds. The sign of the interval is
+    ignored, so ``"-24h"`` and ``"+24h"`` are both a day long.
+
+    :raises ValueError: if ``interval`` isn't a valid interval
+    """
+    if isinstance(interval, Number):
+        return interval
+    match = re.match(r'^[+-]?(\d*)([smhdwMyY])$', str(interval))
+    if not match:
+        raise ValueError("Invalid interval: {!r}".format(interval))
+    count, unit = match.groups()
+    return int(count or 1) * INTERVAL_UNITS[unit]
+
+
+def relative_time_to_seconds(time):
+    """Convert a time relative to now, such as ``"now-7d"``, to seconds ago.
+
+    Rounding, as in ``"now-1d/d"``, is ignored.
+
+    :raises ValueError: if ``time`` isn't relative to now
+    """
+    match = re.match(r'^now(?:-(\d*[smhdwMyY]))?(?:/[smhdwMyY])?$', time)
+    if not match:
+        raise ValueError(
+            "Expected a time relative to now, such as 'now-7d', "
+            "got {!r}".format(time))
+    return interval_to_seconds(match.group(1)) if match.group(1) else 0
+
+
+def panel_time_range(dashboard, panel):
+    """Find the time range a panel shows, in seconds before now.
+
+    Takes the panel's ``timeFrom`` and ``timeShift`` overrides into account.
+
+    :return: A tuple of the start and end of the range, in seconds ago
+    """
+    start = relative_time_to_seconds(dashboard.time.start)
+    end = relative_time_to_seconds(dashboard.time.end)
+    if getattr(panel, 'timeFrom', None):
+        start, end = interval_to_seconds(panel.timeFrom), 0
+    if getattr(panel, 'timeShift', None):
+        shift = interval_to_seconds(panel.timeShift)
+        start, end = start + shift, end + shift
+    return start, end
+
 
 @attr.s
 class Mapping(object):
@@ -166,6 +230,10 @@ VTYPE_DELTA = "delta"
 VTYPE_RANGE = "range"
 VTYPE_DEFAULT = VTYPE_AVG
 
+# Value types that only look at the latest point of a series, and so give the
+# same answer for an instant query as for a range query.
+INSTANT_VALUE_TYPES = (VTYPE_CURR, VTYPE_NAME)
+
 
 @attr.s
 class Grid(object):
@@ -221,6 +289,18 @@ class Legend(object):
 
 @attr.s
 class Target(object):
+    """A Prometheus query.
+
+    :param expr: the Prometheus expression
+    :param legendFormat: legend template, e.g. ``{{instance}}``
+    :param intervalFactor: resolution factor for range queries
+    :param metric: metric name hint used by the query editor
+    :param refId: target reference id
+    :param step: step between points of a range query, in seconds
+    :param instant: ``True`` to run an instant query, which returns only the
+        latest value of each series. ``False`` to run a range query. ``None``
+        (the default) lets the panel decide; see ``SingleStat``.
+    """
 
     expr = attr.ib()
     legendFormat = attr.ib(default="")
@@ -228,10 +308,15 @@ class Target(object):
     metric = attr.ib(default="")
     refId = attr.ib(default="")
     step = attr.ib(default=DEFAULT_STEP)
+    instant = attr.ib(
+        default=None,
+        validator=attr.validators.optional(instance_of(bool)),
+    )
 
     def to_json_data(self):
         return {
             'expr': self.expr,
+            'instant': bool(self.instant),
             'intervalFactor': self.intervalFactor,
             'legendFormat': self.legendFormat,
             'metric': self.metric,
@@ -240,6 +325,36 @@ class Target(object):
         }
 
 
+# Panel options that control how long Grafana and its data sources may reuse
+# query results, and how long queries may take. A ``Dashboard`` can set
+# defaults for these.
+QUERY_CACHE_OPTIONS = ('cacheTimeout', 'queryCachingTTL', 'queryTimeout')
+
+# Grafana's built-in data source for reusing another panel's query results
+DASHBOARD_DATA_SOURCE = '-- Dashboard --'
+
+
+@attr.s
+class DashboardTarget(object):
+    """Reuse the query results of another panel on the same dashboard.
+
+    Use with ``DASHBOARD_DATA_SOURCE`` as the panel's data source. Needs
+    Grafana 5.3 or later.
+
+    :param panelId: id of the panel whose results to reuse
+    :param refId: target reference id
+    """
+
+    panelId = attr.ib(validator=instance_of(int))
+    refId = attr.ib(default="A")
+
+    def to_json_data(self):
+        return {
+            'panelId': self.panelId,
+            'refId': self.refId,
+        }
+
+
 @attr.s
 class Tooltip(object):
 
@@ -434,6 +549,15 @@ class DashboardLink(object):
         }
 
 
+# When template variables are refreshed from their data source
+REFRESH_NEVER = 0
+REFRESH_ON_DASHBOARD_LOAD = 1
+REFRESH_ON_TIME_RANGE_CHANGE = 2
+
+TEMPLATE_REFRESH_POLICIES = (
+    REFRESH_NEVER, REFRESH_ON_DASHBOARD_LOAD, REFRESH_ON_TIME_RANGE_CHANGE)
+
+
 @attr.s
 class Template(object):
     """Template create a new 'variable' for the dashboard, defines the variable
@@ -448,6 +572,12 @@ class Template(object):
             globs or lucene syntax.
         :param includeAll: Add a special All option whose value includes
             all options.
+        :param refresh: when to query the data source for the variable's
+            values. One of ``REFRESH_NEVER``, ``REFRESH_ON_DASHBOARD_LOAD`` or
+            ``REFRESH_ON_TIME_RANGE_CHANGE``.
+        :param options: values to offer before the data source has been
+            queried. With ``REFRESH_NEVER``, these are the only values
+            offered. See ``with_options``.
     """
 
     default = attr.ib()
@@ -460,8 +590,36 @@ class Template(object):
         default=False,
         validator=instance_of(bool),
     )
+    refresh = attr.ib(
+        default=REFRESH_ON_DASHBOARD_LOAD,
+        validator=is_in(TEMPLATE_REFRESH_POLICIES),
+    )
+    options = attr.ib(default=attr.Factory(list))
+
+    def with_options(self, values):
+        """Offer a fixed list of values, rather than querying for them.
+
+        Returns a new ``Template`` that is the same as this one, except it
+        never queries its data source and offers ``values`` instead. The
+        default value is kept if it is one of ``values``, otherwise the first
+        value becomes the default.
+        """
+        values = list(values)
+        default = self.default
+        if values and default not in values:
+            default = values[0]
+        return attr.assoc(
+            self, default=default, options=values, refresh=REFRESH_NEVER)
 
     def to_json_data(self):
+        options = [
+            {
+                'selected': value == self.default,
+                'text': value,
+                'value': value,
+            }
+            for value in self.options
+        ]
         return {
             'allValue': self.allValue,
             'current': {
@@ -475,9 +633,9 @@ class Template(object):
             'label': self.label,
             'multi': False,
             'name': self.name,
-            'options': [],
+            'options': options,
             'query': self.query,
-            'refresh': 1,
+            'refresh': self.refresh,
             'regex': '',
             'sort': 1,
             'tagValuesQuery': None,
@@ -486,10 +644,54 @@ class Template(object):
         }
 
 
+# References to template variables: $var, ${var} or ${var:format}, and [[var]]
+_VARIABLE_REFERENCE = re.compile(r'\$(\w+)|\$\{(\w+)[^}]*\}|\[\[(\w+)')
+
+
 @attr.s
 class Templating(object):
     list = attr.ib(default=attr.Factory(list))
 
+    def with_static_options(self, inventory):
+        """Fill in template variables from an inventory at generation time.
+
+        Dashboards load faster when their variables don't need a round trip
+        to a data source. Every template named in ``inventory`` is given a
+        fixed list of options with ``Template.with_options``; the others are
+        left alone.
+
+        Chained variables, whose queries use earlier variables, only get
+        their options for the earlier variables' defaults. They keep their
+        refresh policy, so that they are queried again when another value is
+        picked for a variable they use.
+
+        :param inventory: A dict mapping variable names to their values. For
+            chained variables, give a function instead. It is called with a
+            dict mapping the names of the variables before it to their
+            default values, and returns a list of values.
+        :return: A new ``Templating``
+        """
+        current = {}
+        templates = []
+        for template in self.list:
+            values = inventory.get(template.name)
+            if callable(values):
+                values = values(dict(current))
+            if values is not None:
+                used = set(
+                    name for groups in _VARIABLE_REFERENCE.findall(
+                        str(template.query))
+                    for name in groups if name)
+                if used & set(current):
+                    template = attr.assoc(
+                        template.with_options(values),
+                        refresh=template.refresh)
+                else:
+                    template = template.with_options(values)
+            current[template.name] = template.default
+            templates.append(template)
+        return attr.assoc(self, list=templates)
+
     def to_json_data(self):
         return {
             'list': self.list,
@@ -672,6 +874,67 @@ class Alert(object):
         }
 
 
+def _panel_targets(panel):
+    """Get the targets a panel will actually query."""
+    resolve_targets = getattr(panel, '_resolve_targets', None)
+    if resolve_targets:
+        return resolve_targets()
+    return getattr(panel, 'targets', None)
+
+
+def _without_ref_id(target):
+    data = dict(target.to_json_data())
+    data.pop('refId', None)
+    return data
+
+
+def _panel_queries(panel, targets):
+    """Describe everything that determines what a panel's queries return."""
+    return (
+        panel.dataSource,
+        getattr(panel, 'timeFrom', None),
+        getattr(panel, 'timeShift', None),
+        getattr(panel, 'interval', None),
+        [_without_ref_id(target) for target in targets],
+    )
+
+
+@attr.s
+class QueryLoad(object):
+    """How many queries a dashboard sends to its data sources.
+
+    :param panelQueries: number of queries run each time the panels refresh
+    :param templateQueries: number of queries run to fill in template
+        variables when the dashboard is loaded
+    :param alertQueriesPerMinute: number of queries the alerting engine runs
+        per minute for the dashboard's alerts
+    :param refresh: the dashboard's auto-refresh interval, or ``None`` if it
+        doesn't refresh automatically
+    :param templateRefreshQueries: number of template variables that are
+        queried again each time the panels refresh
+    """
+
+    panelQueries = attr.ib(validator=instance_of(int))
+    templateQueries = attr.ib(validator=instance_of(int))
+    alertQueriesPerMinute = attr.ib(validator=instance_of(Number))
+    refresh = attr.ib(default=None)
+    templateRefreshQueries = attr.ib(default=0, validator=instance_of(int))
+
+    def per_minute(self):
+        """Queries per minute for a single viewer of the dashboard.
+
+        Alert queries don't depend on the number of viewers, but are included
+        so that a dashboard's budget covers everything it asks of the data
+        sources. ``templateQueries`` are left out, as they only run when the
+        dashboard is loaded, but ``templateRefreshQueries`` are counted.
+        """
+        if not self.refresh:
+            return self.alertQueriesPerMinute
+        refreshes = 60 / interval_to_seconds(self.refresh)
+        queries = self.panelQueries + self.templateRefreshQueries
+        return queries * refreshes + self.alertQueriesPerMinute
+
+
 @attr.s
 class Dashboard(object):
 
@@ -681,6 +944,8 @@ class Dashboard(object):
         default=Annotations(),
         validator=instance_of(Annotations),
     )
+    # Default cacheTimeout for panels that don't set their own
+    cacheTimeout = attr.ib(default=None)
     editable = attr.ib(
         default=True,
         validator=instance_of(bool),
@@ -692,6 +957,10 @@ class Dashboard(object):
     )
     id = attr.ib(default=None)
     links = attr.ib(default=attr.Factory(list))
+    # Default queryCachingTTL for panels that don't set their own
+    queryCachingTTL = attr.ib(default=None)
+    # Default queryTimeout for panels that don't set their own
+    queryTimeout = attr.ib(default=None)
     refresh = attr.ib(default=DEFAULT_REFRESH)
     schemaVersion = attr.ib(default=SCHEMA_VERSION)
     sharedCrosshair = attr.ib(
@@ -738,7 +1007,124 @@ class Dashboard(object):
             return panel if panel.id else attr.assoc(panel, id=next(auto_ids))
         return self._map_panels(set_id)
 
+    def query_load(self, refresh=None):
+        """Estimate the query load of this dashboard.
+
+        Panels on ``DASHBOARD_DATA_SOURCE`` reuse another panel's results, so
+        they don't add to the load.
+
+        :param refresh: Estimate the load for this refresh interval instead
+            of the dashboard's own ``refresh``.
+        :return: A ``QueryLoad``
+        """
+        panelQueries = 0
+        alertQueriesPerMinute = 0
+        for panel in self._iter_panels():
+            if getattr(panel, 'dataSource', None) != DASHBOARD_DATA_SOURCE:
+                panelQueries += len(getattr(panel, 'targets', None) or [])
+            alert = getattr(panel, 'alert', None)
+            if alert:
+                alertQueriesPerMinute += (
+                    len(alert.alertConditions) * 60 /
+                    interval_to_seconds(alert.frequency))
+        refreshes = [
+            getattr(template, 'refresh', REFRESH_ON_DASHBOARD_LOAD)
+            for template in self.templating.list
+        ]
+        return QueryLoad(
+            panelQueries=panelQueries,
+            templateQueries=sum(
+                1 for policy in refreshes if policy != REFRESH_NEVER),
+            alertQueriesPerMinute=alertQueriesPerMinute,
+            refresh=self.refresh if refresh is None else refresh,
+            templateRefreshQueries=refreshes.count(
+                REFRESH_ON_TIME_RANGE_CHANGE),
+        )
+
+    def auto_refresh(self, budget):
+        """Refresh as often as a query budget allows.
+
+        Returns a new ``Dashboard`` that is the same as this one, except its
+        ``refresh`` is the shortest of the time picker's refresh intervals
+        that keeps the dashboard within ``budget``. Dashboards that are
+        already within budget, or that don't refresh automatically, are
+        returned unchanged, and this never makes a dashboard refresh more
+        often than it was written to.
+
+        :param budget: Maximum number of queries per minute per viewer. See
+            ``QueryLoad.per_minute``, which leaves out the template queries
+            run when the dashboard is loaded.
+        :raises ValueError: if no refresh interval fits within the budget
+        """
+        if not self.refresh or self.query_load().per_minute() <= budget:
+            return self
+        floor = interval_to_seconds(self.refresh)
+        intervals = sorted(
+            self.timePicker.refreshIntervals, key=interval_to_seconds)
+        for interval in intervals:
+            if interval_to_seconds(interval) < floor:
+                continue
+            if self.query_load(refresh=interval).per_minute() <= budget:
+                return attr.assoc(self, refresh=interval)
+        raise ValueError(
+            "Dashboard {!r} cannot refresh within a budget of {} queries "
+            "per minute".format(self.title, budget))
+
+    def share_duplicate_queries(self):
+        """Stop panels from running the same queries twice.
+
+        A panel that runs exactly the same queries as an earlier panel, on
+        the same data source and over the same time range, is changed to
+        reuse the earlier panel's results through ``DASHBOARD_DATA_SOURCE``.
+        Panels with alerts always run their own queries, because Grafana's
+        alerting needs a real data source.
+
+        Panels without IDs are given them, as per ``auto_panel_ids``.
+
+        :return: A tuple of the new ``Dashboard``, and the number of queries
+            per refresh that it saves.
+        """
+        dashboard = self.auto_panel_ids()
+        sources = []
+        saved = []
+
+        def share(panel):
+            targets = _panel_targets(panel)
+            if not targets or panel.dataSource == DASHBOARD_DATA_SOURCE:
+                return panel
+            queries = _panel_queries(panel, targets)
+            has_alert = getattr(panel, 'alert', None)
+            for other_queries, panel_id in sources:
+                if queries == other_queries and not has_alert:
+                    saved.append(len(targets))
+                    return attr.assoc(
+                        panel,
+                        dataSource=DASHBOARD_DATA_SOURCE,
+                        targets=[DashboardTarget(panelId=panel_id)],
+                    )
+            sources.append((queries, panel.id))
+            return panel
+        return dashboard._map_panels(share), sum(saved)
+
+    def _apply_query_defaults(self):
+        """Give panels the dashboard's cache and timeout settings, unless they
+        have their own.
+        """
+        defaults = {
+            name: getattr(self, name) for name in QUERY_CACHE_OPTIONS
+            if getattr(self, name) is not None
+        }
+
+        def set_defaults(panel):
+            changes = {
+                name: value for name, value in defaults.items()
+                if hasattr(panel, name) and getattr(panel, name) is None
+            }
+            return attr.assoc(panel, **changes) if changes else panel
+        return self._map_panels(set_defaults) if defaults else self
+
     def to_json_data(self):
+        rows = self._apply_query_defaults().rows
         return {
             'annotations': self.annotations,
             'editable': self.editable,
@@ -747,7 +1133,7 @@ class Dashboard(object):
             'id': self.id,
             'links': self.links,
             'refresh': self.refresh,
-            'rows': self.rows,
+            'rows': rows,
             'schemaVersion': self.schemaVersion,
             'sharedCrosshair': self.sharedCrosshair,
             'style': self.style,
@@ -763,17 +1149,28 @@ class Dashboard(object):
 
 @attr.s
 class Graph(object):
+    """Generates Graph panel json structure.
+
+    :param cacheTimeout: metric query result cache ttl
+    :param hideTimeOverride: hides time overrides
+    :param queryCachingTTL: how long, in milliseconds, data sources with
+        query caching may cache this panel's results
+    :param queryTimeout: how long data sources that support it may take to
+        run this panel's queries, e.g. ``"30s"``
+    """
 
     title = attr.ib()
     dataSource = attr.ib()
     targets = attr.ib()
     aliasColors = attr.ib(default=attr.Factory(dict))
     bars = attr.ib(default=False, validator=instance_of(bool))
+    cacheTimeout = attr.ib(default=None)
     description = attr.ib(default=None)
     editable = attr.ib(default=True, validator=instance_of(bool))
     error = attr.ib(default=False, validator=instance_of(bool))
     fill = attr.ib(default=1, validator=instance_of(int))
     grid = attr.ib(default=attr.Factory(Grid), validator=instance_of(Grid))
+    hideTimeOverride = attr.ib(default=False, validator=instance_of(bool))
     id = attr.ib(default=None)
     isNew = attr.ib(default=True, validator=instance_of(bool))
     legend = attr.ib(
@@ -787,6 +1184,8 @@ class Graph(object):
     percentage = attr.ib(default=False, validator=instance_of(bool))
     pointRadius = attr.ib(default=DEFAULT_POINT_RADIUS)
     points = attr.ib(default=False, validator=instance_of(bool))
+    queryCachingTTL = attr.ib(default=None)
+    queryTimeout = attr.ib(default=None)
     renderer = attr.ib(default=DEFAULT_RENDERER)
     seriesOverrides = attr.ib(default=attr.Factory(list))
     span = attr.ib(default=None)
@@ -811,12 +1210,14 @@ class Graph(object):
         graphObject = {
             'aliasColors': self.aliasColors,
             'bars': self.bars,
+            'cacheTimeout': self.cacheTimeout,
             'datasource': self.dataSource,
             'description': self.description,
             'editable': self.editable,
             'error': self.error,
             'fill': self.fill,
             'grid': self.grid,
+            'hideTimeOverride': self.hideTimeOverride,
             'id': self.id,
             'isNew': self.isNew,
             'legend': self.legend,
@@ -827,6 +1228,8 @@ class Graph(object):
             'percentage': self.percentage,
             'pointradius': self.pointRadius,
             'points': self.points,
+            'queryCachingTTL': self.queryCachingTTL,
+            'queryTimeout': self.queryTimeout,
             'renderer': self.renderer,
             'seriesOverrides': self.seriesOverrides,
             'span': self.span,
@@ -978,6 +1381,10 @@ class SingleStat(object):
     :param postfixFontSize: defines postfix font size
     :param prefix: defines prefix that will be attached to value
     :param prefixFontSize: defines prefix font size
+    :param queryCachingTTL: how long, in milliseconds, data sources with
+        query caching may cache this panel's results
+    :param queryTimeout: how long data sources that support it may take to
+        run this panel's queries, e.g. ``"30s"``
     :param rangeMaps: the list of value to text mappings
     :param span: defines the number of spans that will be used for panel
     :param sparkline: defines if grafana should draw an additional sparkline.
@@ -989,6 +1396,11 @@ class SingleStat(object):
     :param valueName: defines value type. possible values are:
         min, max, avg, current, total, name, first, delta, range
     :param valueMaps: the list of value to text mappings
+
+    Prometheus ``Target`` objects that don't say whether they are instant
+    queries are run as instant queries if this panel only needs the latest
+    value of each series, i.e. ``valueName`` is one of
+    ``INSTANT_VALUE_TYPES`` and the sparkline is hidden.
     """
 
     dataSource = attr.ib()
@@ -1020,6 +1432,8 @@ class SingleStat(object):
     postfixFontSize = attr.ib(default="50%")
     prefix = attr.ib(default="")
     prefixFontSize = attr.ib(default="50%")
+    queryCachingTTL = attr.ib(default=None)
+    queryTimeout = attr.ib(default=None)
     rangeMaps = attr.ib(default=attr.Factory(list))
     repeat = attr.ib(default=None)
     span = attr.ib(default=6)
@@ -1031,6 +1445,19 @@ class SingleStat(object):
     valueName = attr.ib(default=VTYPE_DEFAULT)
     valueMaps = attr.ib(default=attr.Factory(list))
 
+    def _instant_is_safe(self):
+        return (
+            self.valueName in INSTANT_VALUE_TYPES and not self.sparkline.show)
+
+    def _resolve_targets(self):
+        instant = self._instant_is_safe()
+        return [
+            attr.assoc(target, instant=instant)
+            if isinstance(target, Target) and target.instant is None
+            else target
+            for target in self.targets
+        ]
+
     def to_json_data(self):
         return {
             'cacheTimeout': self.cacheTimeout,
@@ -1058,11 +1485,13 @@ class SingleStat(object):
             'postfixFontSize': self.postfixFontSize,
             'prefix': self.prefix,
             'prefixFontSize': self.prefixFontSize,
+            'queryCachingTTL': self.queryCachingTTL,
+            'queryTimeout': self.queryTimeout,
             'rangeMaps': self.rangeMaps,
             'repeat': self.repeat,
             'span': self.span,
             'sparkline': self.sparkline,
-            'targets': self.targets,
+            'targets': self._resolve_targets(),
             'thresholds': self.thresholds,
             'title': self.title,
             'transparent': self.transparent,
@@ -1071,3 +1500,22 @@ class SingleStat(object):
             'valueMaps': self.valueMaps,
             'valueName': self.valueName
         }
+
+
+def find_range_query_single_stats(dashboard):
+    """Find ``SingleStat`` panels that run Prometheus range queries.
+
+    A single stat only ever shows one value per series, so a range query
+    often fetches hundreds of points only to throw them away. Panels listed
+    here should either set ``instant=True`` on their targets, or use a
+    ``valueName`` from ``INSTANT_VALUE_TYPES``.
+
+    :param dashboard: A ``Dashboard``
+    :return: A list of the offending ``SingleStat`` panels
+    """
+    return [
+        panel for panel in dashboard._iter_panels()
+        if isinstance(panel, SingleStat) and any(
+            isinstance(target, Target) and not target.instant
+            for target in panel._resolve_targets())
+    ]
@@ -1,8 +1,11 @@
 """Support for OpenTSDB."""
 
+import warnings
+
 import attr
-from attr.validators import instance_of
-from grafanalib.validators import is_in
+from attr.validators import instance_of, optional
+from grafanalib.validators import is_in, is_interval, is_list_of
+from grafanalib.core import TOTAL_SPAN, interval_to_seconds, panel_time_range
 
 # OpenTSDB aggregators
 OTSDB_AGG_AVG = "avg"
@@ -44,6 +47,36 @@ OTSDB_QUERY_FILTERS = (
     'not_iliteral_or', 'wildcard', 'iwildcard', 'regexp')
 OTSDB_QUERY_FILTER_DEFAULT = 'literal_or'
 
+# How queries use rollup tables, as of OpenTSDB 2.4
+OTSDB_ROLLUP_RAW = 'ROLLUP_RAW'
+OTSDB_ROLLUP_NOFALLBACK = 'ROLLUP_NOFALLBACK'
+OTSDB_ROLLUP_FALLBACK = 'ROLLUP_FALLBACK'
+OTSDB_ROLLUP_FALLBACK_RAW = 'ROLLUP_FALLBACK_RAW'
+OTSDB_ROLLUP_USAGES = (
+    OTSDB_ROLLUP_RAW, OTSDB_ROLLUP_NOFALLBACK, OTSDB_ROLLUP_FALLBACK,
+    OTSDB_ROLLUP_FALLBACK_RAW)
+
+# Downsampling intervals that downsample_interval picks from
+OTSDB_DOWNSAMPLE_INTERVALS = (
+    '10s', '30s', '1m', '5m', '10m', '30m',
+    '1h', '3h', '6h', '12h', '1d', '1w')
+
+# Width in pixels of a panel that spans the whole dashboard
+DEFAULT_SCREEN_WIDTH = 1920
+# How often points are written to OpenTSDB
+DEFAULT_RESOLUTION = '10s'
+
+# Downsampling aggregators for the aggregators that don't average
+_DOWNSAMPLE_AGGREGATORS = {
+    OTSDB_AGG_COUNT: OTSDB_AGG_SUM,
+    OTSDB_AGG_MAX: OTSDB_AGG_MAX,
+    OTSDB_AGG_MIMMAX: OTSDB_AGG_MAX,
+    OTSDB_AGG_MIMMIN: OTSDB_AGG_MIN,
+    OTSDB_AGG_MIN: OTSDB_AGG_MIN,
+    OTSDB_AGG_SUM: OTSDB_AGG_AVG,
+    OTSDB_AGG_ZIMSUM: OTSDB_AGG_AVG,
+}
+
 
 @attr.s
 class OpenTSDBFilter(object):
@@ -102,6 +135,12 @@ class OpenTSDBTarget(object):
     :param currentFilterKey: defines current filter key
     :param currentFilterType: defines current filter type
     :param currentFilterValue: defines current filter value
+    :param rollupUsage: defines if and how rollup tables should be used,
+        one of OTSDB_ROLLUP_USAGES. Only sent when set.
+        OpenTSDB docs on rollups:
+        http://opentsdb.net/docs/build/html/user_guide/rollups.html
+    :param preAggregate: defines if pre-aggregated series should be read.
+        Only sent when set.
     """
 
     metric = attr.ib()
@@ -123,10 +162,13 @@ class OpenTSDBTarget(object):
     currentFilterKey = attr.ib(default="")
     currentFilterType = attr.ib(default=OTSDB_QUERY_FILTER_DEFAULT)
     currentFilterValue = attr.ib(default="")
+    rollupUsage = attr.ib(
+        default=None, validator=optional(is_in(OTSDB_ROLLUP_USAGES)))
+    preAggregate = attr.ib(default=None, validator=optional(instance_of(bool)))
 
     def to_json_data(self):
 
-        return {
+        data = {
             'aggregator': self.aggregator,
             'alias': self.alias,
             'isCounter': self.isCounter,
@@ -145,3 +187,337 @@ class OpenTSDBTarget(object):
             'currentFilterType': self.currentFilterType,
             'currentFilterValue': self.currentFilterValue,
         }
+        if self.rollupUsage is not None:
+            data['rollupUsage'] = self.rollupUsage
+        if self.preAggregate is not None:
+            data['preAggregate'] = self.preAggregate
+        return data
+
+
+class RawResolutionWarning(UserWarning):
+    """A target reads more points than its panel can show."""
+
+
+def _panel_width(panel, screenWidth):
+    return screenWidth * (getattr(panel, 'span', None) or TOTAL_SPAN) / \
+        TOTAL_SPAN
+
+
+def downsample_interval(seconds, width,
+                        intervals=OTSDB_DOWNSAMPLE_INTERVALS):
+    """Pick the shortest interval that gives at most a point per pixel.
+
+    :param seconds: length of the time range
+    :param width: width of the panel, in pixels
+    :param intervals: intervals to pick from, shortest first
+    :return: One of ``intervals``. The longest if none is long enough.
+    """
+    for interval in intervals:
+        if seconds / interval_to_seconds(interval) <= width:
+            return interval
+    return intervals[-1]
+
+
+def _has_opentsdb_targets(panel):
+    return any(
+        isinstance(target, OpenTSDBTarget)
+        for target in getattr(panel, 'targets', None) or [])
+
+
+def _panel_view(dashboard, panel, screenWidth):
+    """Get the width of a panel, and the length of its time range."""
+    start, end = panel_time_range(dashboard, panel)
+    return _panel_width(panel, screenWidth), start - end
+
+
+def find_raw_resolution_targets(dashboard, screenWidth=DEFAULT_SCREEN_WIDTH,
+                                resolution=DEFAULT_RESOLUTION):
+    """Find OpenTSDB targets that read more points than there are pixels.
+
+    These are targets that disable downsampling, or whose
+    ``downsampleInterval`` is too short for the dashboard's time range.
+    Targets without a ``downsampleInterval`` are downsampled to Grafana's
+    automatic interval, so they are fine.
+
+    :param dashboard: ``Dashboard`` with a relative time range
+    :param screenWidth: width in pixels of a panel with the full span
+    :param resolution: how often points are written to OpenTSDB
+    :return: A list of ``(panel, target, points)`` tuples, where ``points``
+        is how many points the target reads for each series
+    """
+    found = []
+    for panel in filter(_has_opentsdb_targets, dashboard._iter_panels()):
+        width, seconds = _panel_view(dashboard, panel, screenWidth)
+        for target in panel.targets:
+            if not isinstance(target, OpenTSDBTarget):
+                continue
+            if target.disableDownsampling:
+                interval = resolution
+            elif target.downsampleInterval:
+                interval = target.downsampleInterval
+            else:
+                continue
+            points = seconds / interval_to_seconds(interval)
+            if points > width:
+                found.append((panel, target, int(points)))
+    return found
+
+
+def _downsampled(target):
+    if target.disableDownsampling or target.downsampleInterval:
+        return target
+    changes = {}
+    if target.downsampleAggregator == OTSDB_AGG_SUM:
+        changes['downsampleAggregator'] = _DOWNSAMPLE_AGGREGATORS.get(
+            target.aggregator, OTSDB_AGG_AVG)
+    if target.downsampleFillPolicy == OTSDB_DOWNSAMPLING_FILL_POLICY_DEFAULT:
+        changes['downsampleFillPolicy'] = (
+            'zero' if target.aggregator == OTSDB_AGG_COUNT else 'null')
+    return attr.assoc(target, **changes) if changes else target
+
+
+def auto_downsample(dashboard, screenWidth=DEFAULT_SCREEN_WIDTH,
+                    resolution=DEFAULT_RESOLUTION):
+    """Fill in the downsampling of OpenTSDB targets.
+
+    The ``downsampleInterval`` of targets is left unset, so that Grafana
+    downsamples them to its automatic interval, which gives about a point
+    per pixel for whatever time range the dashboard is viewed over. Targets
+    that don't set one and still use the default downsampling aggregator and
+    fill policy get ones that match their ``aggregator``: ``max`` for
+    ``max``, ``sum`` filled with zeros for ``count``, and ``avg`` filled with
+    nulls otherwise, so gaps aren't interpolated away.
+
+    Targets found by ``find_raw_resolution_targets`` are left alone, and a
+    ``RawResolutionWarning`` is issued for each.
+
+    :param dashboard: ``Dashboard`` with a relative time range
+    :param screenWidth: width in pixels of a panel with the full span
+    :param resolution: how often points are written to OpenTSDB
+    :return: A new ``Dashboard``
+    """
+    for panel, target, points in find_raw_resolution_targets(
+            dashboard, screenWidth, resolution):
+        warnings.warn(
+            "{!r} in panel {!r} reads {} points per series, for a panel "
+            "{} pixels wide".format(
+                target.metric, panel.title, points,
+                int(_panel_width(panel, screenWidth))),
+            RawResolutionWarning, stacklevel=2)
+
+    def downsample(panel):
+        if not _has_opentsdb_targets(panel):
+            return panel
+        return attr.assoc(panel, targets=[
+            _downsampled(target)
+            if isinstance(target, OpenTSDBTarget) else target
+            for target in panel.targets
+        ])
+    return dashboard._map_panels(downsample)
+
+
+def _coalesce_key(target, index):
+    """What a target queries, apart from the value of one of its filters.
+
+    :return: ``None`` if the filter can't be coalesced with others
+    """
+    filter = target.filters[index]
+    if (filter.type != 'literal_or' or '|' in filter.value or
+            not filter.value):
+        return None
+    filters = list(target.filters)
+    filters[index] = attr.assoc(filter, value='', groupBy=False)
+    return attr.assoc(target, refId='', alias=None, filters=filters), index
+
+
+def _alias_pattern(targets, index):
+    """Find an alias that gives each target its alias through ``$tag_``.
+
+    :return: The alias, or ``False`` if there is none
+    """
+    tag = targets[0].filters[index].tag
+    values = [target.filters[index].value for target in targets]
+    aliases = [target.alias for target in targets]
+    if all(alias is None for alias in aliases):
+        return None
+    if any(alias is None or value not in alias
+           for alias, value in zip(aliases, values)):
+        return False
+    pattern = aliases[0].replace(values[0], '$tag_' + tag)
+    if all(pattern.replace('$tag_' + tag, value) == alias
+           for alias, value in zip(aliases, values)):
+        return pattern
+    return False
+
+
+def _coalesce(targets):
+    """Merge targets that differ only in the value of a literal filter.
+
+    :return: A tuple of the new list of targets, and how many were removed
+    """
+    groups = []
+    for target in targets:
+        if not isinstance(target, OpenTSDBTarget):
+            continue
+        for index in range(len(target.filters)):
+            key = _coalesce_key(target, index)
+            if key is None:
+                continue
+            for group_key, members in groups:
+                if group_key == key:
+                    members.append(target)
+                    break
+            else:
+                groups.append((key, [target]))
+    groups.sort(key=lambda group: len(group[1]), reverse=True)
+    merged = {}
+    for (_, index), members in groups:
+        if len(members) < 2 or any(id(t) in merged for t in members):
+            continue
+        values = [target.filters[index].value for target in members]
+        alias = _alias_pattern(members, index)
+        if len(set(values)) < len(values) or alias is False:
+            continue
+        filters = list(members[0].filters)
+        filters[index] = attr.assoc(
+            filters[index], value='|'.join(values), groupBy=True)
+        combined = attr.assoc(members[0], filters=filters, alias=alias)
+        for target in members:
+            merged[id(target)] = combined
+    result = []
+    for target in targets:
+        target = merged.get(id(target), target)
+        if not any(target is other for other in result):
+            result.append(target)
+    return result, len(targets) - len(result)
+
+
+def coalesce_targets(dashboard):
+    """Merge OpenTSDB targets that differ only in a filter's value.
+
+    Within each panel, targets that query the same metric in the same way,
+    except for the value of one ``literal_or`` filter, are merged into a
+    single target that filters on all of the values and groups by the tag.
+    Grafana then sends one query instead of several, and gets back the same
+    series. Aliases are kept by replacing the value in them with
+    ``$tag_<tag>``; targets whose aliases can't be kept that way aren't
+    merged.
+
+    Panels with alerts are left alone, since their conditions refer to
+    targets by ``refId``.
+
+    :return: A tuple of the new ``Dashboard``, and the number of queries
+        per refresh that it saves.
+    """
+    saved = []
+
+    def coalesce(panel):
+        targets = getattr(panel, 'targets', None)
+        if not targets or getattr(panel, 'alert', None):
+            return panel
+        targets, removed = _coalesce(targets)
+        if not removed:
+            return panel
+        saved.append(removed)
+        return attr.assoc(panel, targets=targets)
+    return dashboard._map_panels(coalesce), sum(saved)
+
+
+@attr.s
+class OpenTSDBRollups(object):
+    """The rollup tables an OpenTSDB cluster keeps, and when to use them.
+
+    :param intervals: the intervals of the rollup tables, e.g. ``"1h"``
+    :param aggregators: the downsampling aggregators the rollup tables keep
+    :param usage: how targets that read rollups should use them, one of
+        OTSDB_ROLLUP_USAGES
+    :param preAggregate: defines if targets should read pre-aggregated
+        series too
+    """
+
+    intervals = attr.ib(default=('1m', '1h', '1d'), convert=tuple)
+    aggregators = attr.ib(
+        default=(OTSDB_AGG_SUM, OTSDB_AGG_COUNT, OTSDB_AGG_MIN,
+                 OTSDB_AGG_MAX, OTSDB_AGG_AVG),
+        convert=tuple)
+    usage = attr.ib(
+        default=OTSDB_ROLLUP_FALLBACK_RAW,
+        validator=is_in(OTSDB_ROLLUP_USAGES))
+    preAggregate = attr.ib(default=False, validator=instance_of(bool))
+
+    @intervals.validator
+    def _check_intervals(self, attribute, intervals):
+        is_list_of(str)(self, attribute, intervals)
+        for interval in intervals:
+            is_interval(self, attribute, interval)
+        if not intervals:
+            raise ValueError("{} should not be empty".format(attribute.name))
+
+    def _sorted_intervals(self):
+        return sorted(self.intervals, key=interval_to_seconds)
+
+    def check(self, target):
+        """Check that a target only asks for rollups that exist.
+
+        :raises ValueError: if the target reads rollups without falling back
+            to raw data, but its downsampling interval or aggregator has no
+            rollup table
+        """
+        if target.rollupUsage != OTSDB_ROLLUP_NOFALLBACK:
+            return
+        fields = attr.fields(OpenTSDBTarget)
+        is_in(self.intervals)(
+            target, fields.downsampleInterval, target.downsampleInterval)
+        is_in(self.aggregators)(
+            target, fields.downsampleAggregator, target.downsampleAggregator)
+
+    def _rollup(self, target, width, seconds):
+        if (target.disableDownsampling or target.rollupUsage is not None or
+                target.downsampleAggregator not in self.aggregators):
+            return target
+        interval = target.downsampleInterval
+        if interval is None:
+            intervals = self._sorted_intervals()
+            wanted = downsample_interval(seconds, width)
+            if interval_to_seconds(wanted) < \
+                    interval_to_seconds(intervals[0]):
+                return target
+            interval = downsample_interval(seconds, width, intervals)
+        elif interval not in self.intervals:
+            return target
+        changes = {'downsampleInterval': interval, 'rollupUsage': self.usage}
+        if self.preAggregate:
+            changes['preAggregate'] = True
+        return attr.assoc(target, **changes)
+
+    def apply(self, dashboard, screenWidth=DEFAULT_SCREEN_WIDTH):
+        """Make OpenTSDB targets over long time ranges read rollups.
+
+        Targets that would be downsampled to at least the shortest rollup
+        interval are given the rollup interval that gives about a point per
+        pixel of their panel, and this policy's ``usage``. Targets that set
+        their own ``downsampleInterval`` only read rollups if it is one of
+        ``intervals``. Targets that disable downsampling, set their own
+        ``rollupUsage``, or use an aggregator the rollups don't keep are left
+        alone. Apply this before ``auto_downsample``, which would otherwise
+        pick intervals that may not have rollups.
+
+        :param dashboard: ``Dashboard`` with a relative time range
+        :param screenWidth: width in pixels of a panel with the full span
+        :return: A new ``Dashboard``
+        :raises ValueError: if a target's rollups fail ``check``
+        """
+        def rollup(panel):
+            if not _has_opentsdb_targets(panel):
+                return panel
+            width, seconds = _panel_view(dashboard, panel, screenWidth)
+            targets = [
+                self._rollup(target, width, seconds)
+                if isinstance(target, OpenTSDBTarget) else target
+                for target in panel.targets
+            ]
+            for target in targets:
+                if isinstance(target, OpenTSDBTarget):
+                    self.check(target)
+            return attr.assoc(panel, targets=targets)
+        return dashboard._map_panels(rollup)
@@ -0,0 +1,88 @@
+"""Tests for alert load estimates."""
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import alertload
+
+
+def _condition(evaluator, operator=G.OP_AND):
+    return G.AlertCondition(
+        G.Target(expr='errors', refId='A'),
+        evaluator=evaluator,
+        timeRange=G.TimeRange("5m", "now"),
+        operator=operator,
+        reducerType=G.RTYPE_AVG,
+    )
+
+
+def _dashboard(alerts):
+    return G.Dashboard(
+        title="Alerts",
+        rows=[G.Row(panels=[
+            G.Graph(title=alert.name, dataSource="Prometheus", targets=[],
+                    alert=alert)
+            for alert in alerts
+        ])],
+    )
+
+
+def _alert(name, *conditions):
+    return G.Alert(name=name, message="", alertConditions=list(conditions))
+
+
+def test_alert_load():
+    dashboard = _dashboard([
+        _alert(str(i), _condition(G.GreaterThan(5))) for i in range(30)])
+    load = alertload.alert_load([dashboard])
+    assert load.alerts == 30
+    assert load.queriesPerSecond == pytest.approx(0.5)
+    assert load.rangeSecondsPerSecond == 150
+    assert load.dataSources == {"Prometheus": pytest.approx(0.5)}
+    assert load.p99Queries == 30
+
+
+def test_stagger_alerts():
+    """Alerts sharing a frequency stop running in the same second."""
+    dashboard = _dashboard([
+        _alert(str(i), _condition(G.GreaterThan(5))) for i in range(30)])
+    [staggered] = alertload.stagger_alerts([dashboard])
+    frequencies = [panel.alert.frequency
+                   for panel in staggered._iter_panels()]
+    assert frequencies[:3] == ['60s', '61s', '59s']
+    assert len(set(frequencies)) == 13
+    assert alertload.alert_load([staggered]).p99Queries < 30
+
+
+def test_merge_conditions():
+    """Bounds on the same query either side of a range are merged."""
+    alert = alertload.merge_conditions(_alert(
+        "Out of range",
+        _condition(G.GreaterThan(10)),
+        _condition(G.LowerThan(5), operator=G.OP_OR),
+        _condition(G.GreaterThan(10), operator=G.OP_OR),
+    ))
+    assert [c.evaluator for c in alert.alertConditions] == [
+        G.OutsideRange(5, 10)]
+
+
+def test_merge_conditions_within_range():
+    """Bounds joined by AND can be met by different series, so are kept."""
+    alert = alertload.merge_conditions(_alert(
+        "Within range",
+        _condition(G.GreaterThan(5)),
+        _condition(G.LowerThan(50)),
+        _condition(G.GreaterThan(5)),
+    ))
+    assert [c.evaluator for c in alert.alertConditions] == [
+        G.GreaterThan(5), G.LowerThan(50)]
+
+
+def test_merge_conditions_mixed_operators():
+    alert = _alert(
+        "Mixed",
+        _condition(G.GreaterThan(5)),
+        _condition(G.LowerThan(10), operator=G.OP_OR),
+        _condition(G.GreaterThan(5)),
+    )
+    assert alertload.merge_conditions(alert) == alert
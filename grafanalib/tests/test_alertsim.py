@@ -0,0 +1,125 @@
+"""Tests for offline alert simulation."""
+
+import attr
+import numpy as np
+import pytest
+
+import grafanalib.core as G
+from grafanalib import alertsim
+
+
+def _alert(*conditions, **kwargs):
+    return G.Alert(
+        name="Test alert", message="", alertConditions=list(conditions),
+        **kwargs)
+
+
+def _condition(evaluator, reducer=G.RTYPE_AVG, operator=G.OP_AND,
+               refId='A', timeRange=G.TimeRange("1m", "now")):
+    return G.AlertCondition(
+        G.Target(expr='up', refId=refId),
+        evaluator=evaluator,
+        timeRange=timeRange,
+        operator=operator,
+        reducerType=reducer,
+    )
+
+
+def _series():
+    # Ten minutes of one point every 10s, high between 3m and 6m.
+    times = np.arange(0, 600, 10)
+    values = np.where((times >= 180) & (times < 360), 10.0, 1.0)
+    return {'A': alertsim.Series(times=times, values=values)}
+
+
+def test_firing_intervals():
+    simulator = alertsim.Simulator(_series())
+    result = simulator.run(
+        _alert(_condition(G.GreaterThan(5), G.RTYPE_MAX), frequency="60s"))
+    assert list(result.times) == [60, 120, 180, 240, 300, 360, 420, 480,
+                                  540]
+    assert result.intervals() == [(180, 420)]
+    assert result.flaps == 2
+
+
+def test_data_shorter_than_time_range():
+    """Alerts looking back further than the data are never evaluated."""
+    simulator = alertsim.Simulator(_series())
+    result = simulator.run(_alert(_condition(
+        G.GreaterThan(5), timeRange=G.TimeRange("1h", "now"))))
+    assert len(result.times) == len(result.firing) == 0
+    assert result.intervals() == []
+    assert result.flaps == 0
+
+
+@pytest.mark.parametrize("reducer,expected", [
+    (G.RTYPE_AVG, 1.5),
+    (G.RTYPE_SUM, 9.0),
+    (G.RTYPE_COUNT, 6.0),
+    (G.RTYPE_MIN, 0.0),
+    (G.RTYPE_MAX, 5.0),
+    (G.RTYPE_MEDIAN, 1.0),
+    (G.RTYPE_LAST, 2.0),
+])
+def test_reducers(reducer, expected):
+    values = np.array([[0.0, 1.0, 5.0, np.nan, 0.0, 1.0, 2.0]])
+    reduced = alertsim._reduce(reducer, values, np.array([0]), np.array([7]))
+    assert reduced[0, 0] == expected
+
+
+def test_operators():
+    simulator = alertsim.Simulator(_series())
+    high = _condition(G.GreaterThan(5))
+    low = _condition(G.LowerThan(5), operator=G.OP_OR)
+    both = simulator.run(_alert(high, attr.assoc(low, operator=G.OP_AND)))
+    either = simulator.run(_alert(high, low))
+    assert not both.firing.any()
+    assert either.firing.all()
+
+
+def test_load_csv(tmpdir):
+    path = tmpdir.join('series.csv')
+    path.write('time,A:a,A:b,B\n0,1,,3\n10,2,5,4\n')
+    series = alertsim.load_series(str(path))
+    assert sorted(series) == ['A', 'B']
+    assert series['A'].values.shape == (2, 2)
+    assert np.isnan(series['A'].values[1, 0])
+
+
+@pytest.mark.parametrize("reducer,naive", [
+    (G.RTYPE_MIN, np.nanmin),
+    (G.RTYPE_MAX, np.nanmax),
+    (G.RTYPE_MEDIAN, np.nanmedian),
+    (G.RTYPE_LAST, lambda window: window[~np.isnan(window)][-1]),
+])
+def test_reducers_match_naive(monkeypatch, reducer, naive):
+    monkeypatch.setattr(alertsim, 'MAX_WINDOW_POINTS', 50)
+    rng = np.random.RandomState(0)
+    values = rng.rand(3, 200)
+    values[rng.rand(3, 200) < 0.3] = np.nan
+    lo = np.sort(rng.randint(0, 200, 40))
+    hi = np.minimum(lo + rng.randint(0, 60, 40), 200)
+    reduced = alertsim._reduce(reducer, values, lo, hi)
+    for series, row in zip(values, reduced):
+        for a, b, value in zip(lo, hi, row):
+            window = series[a:b]
+            if np.isnan(window).all():
+                assert np.isnan(value)
+            else:
+                assert value == naive(window)
+
+
+def test_alerts_sharing_a_ref_id():
+    """Alerts are matched to series by query, not by refId."""
+    times = np.arange(0, 600, 10)
+    simulator = alertsim.Simulator({
+        'up': alertsim.Series(times=times, values=np.ones(len(times))),
+        'down': alertsim.Series(times=times, values=np.zeros(len(times))),
+    })
+    condition = _condition(G.GreaterThan(0.5))
+    up, down = simulator.run_all([
+        _alert(condition),
+        _alert(attr.assoc(condition, target=G.Target(expr='down'))),
+    ])
+    assert up.firing.all()
+    assert not down.firing.any()
@@ -0,0 +1,97 @@
+"""Tests for building objects in bulk."""
+
+import csv
+from io import StringIO
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import bulk, weave
+import grafanalib.zabbix as Z
+
+
+EXPRESSIONS = [
+    'sum(irate(requests_total{{job="{service}",code=~"%s.."}}[1m]))' % code
+    for code in range(1, 6)
+]
+
+
+def test_qps_graphs_match_per_row():
+    """Bulk QPS graphs are the same as building them one at a time."""
+    services = ['users', 'orders']
+    graphs = bulk.qps_graphs(
+        {'service': services}, data_source='Prometheus',
+        title='{service} QPS', expressions=EXPRESSIONS)
+    assert graphs == [
+        weave.QPSGraph(
+            data_source='Prometheus',
+            title='{} QPS'.format(service),
+            expressions=[e.format(service=service) for e in EXPRESSIONS],
+        )
+        for service in services
+    ]
+
+
+def test_objects_dont_share_settings():
+    """Changing one object built in bulk leaves the others alone."""
+    graphs = bulk.qps_graphs(
+        {'service': ['users', 'orders']}, data_source='Prometheus',
+        title='{service} QPS', expressions=EXPRESSIONS)
+    graphs[0].yAxes.left.format = G.SECONDS_FORMAT
+    graphs[0].aliasColors['1xx'] = 'red'
+    assert graphs[1].yAxes.left.format == G.OPS_FORMAT
+    assert graphs[1].aliasColors == weave.ALIAS_COLORS
+
+    targets = bulk.zabbix_metric_targets(
+        {'host': ['web-1', 'web-2']}, application='CPU', group='Web',
+        host='{host}', item='/CPU/', functions=[Z.ZabbixDeltaFunction()])
+    targets[0].functions.append(Z.ZabbixDeltaFunction())
+    assert len(targets[1].functions) == 1
+
+    alerts = bulk.alerts(
+        {'service': ['users', 'orders']}, name='{service}', message='',
+        expr='errors', threshold=5)
+    alerts[0].alertConditions[0].timeRange.from_time = '1h'
+    assert alerts[1].alertConditions[0].timeRange == G.TimeRange('5m', 'now')
+
+
+def test_unknown_column():
+    with pytest.raises(ValueError):
+        bulk.prom_graphs(
+            {'service': ['users']}, data_source='Prometheus',
+            title='{host}', expressions=[])
+
+
+def test_different_column_lengths():
+    with pytest.raises(ValueError):
+        bulk.prom_graphs(
+            {'service': ['users'], 'team': []}, data_source='Prometheus',
+            title='{service}', expressions=[])
+
+
+def test_alerts_from_csv():
+    reader = csv.DictReader(StringIO(
+        'service,max_errors\nusers,5\norders,10\n'))
+    alerts = bulk.alerts(
+        reader, name='{service} errors', message='Too many errors',
+        expr='errors{{job="{service}"}}', threshold='max_errors')
+    assert [alert.name for alert in alerts] == [
+        'users errors', 'orders errors']
+    assert alerts[1].alertConditions[0].evaluator == G.GreaterThan(10.0)
+    assert alerts[1].alertConditions[0].target.expr == 'errors{job="orders"}'
+
+
+def test_alerts_non_numeric_threshold():
+    with pytest.raises(ValueError):
+        bulk.alerts(
+            {'service': ['users'], 'max_errors': ['lots']}, name='{service}',
+            message='', expr='errors', threshold='max_errors')
+
+
+def test_zabbix_metric_targets():
+    targets = bulk.zabbix_metric_targets(
+        {'host': ['web-1', 'web-2']}, application='CPU',
+        group='Web servers', host='{host}', item='/CPU (load)/')
+    assert targets[1] == Z.zabbixMetricTarget(
+        application='CPU', group='Web servers', host='web-2',
+        item='/CPU (load)/')
@@ -0,0 +1,145 @@
+"""Tests for uploading dashboards to Grafana."""
+
+import http.client
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import _deploy, _gen
+from grafanalib._fake_grafana import FakeGrafana
+
+
+@pytest.fixture
+def grafana():
+    with FakeGrafana() as server:
+        yield server
+
+
+def _write_dashboards(tmpdir, count):
+    paths = []
+    for i in range(count):
+        path = tmpdir.join('service-{}.json'.format(i))
+        with open(str(path), 'w') as json_file:
+            _gen.write_dashboard(G.Dashboard(
+                title='Service {}'.format(i), rows=[]), json_file)
+        paths.append(str(path))
+    return paths
+
+
+def test_canonical_hash():
+    dashboard = {'title': 'A', 'rows': [], 'id': None}
+    deployed = {'rows': [], 'title': 'A', 'id': 4, 'version': 3}
+    assert _deploy.canonical_hash(dashboard) == \
+        _deploy.canonical_hash(deployed)
+    assert _deploy.canonical_hash(dashboard) != \
+        _deploy.canonical_hash(dict(dashboard, title='B'))
+
+
+class _StaleConnection(object):
+    """A pooled connection that Grafana has closed."""
+
+    def __init__(self):
+        self.sent = []
+
+    def request(self, method, url, body, headers):
+        self.sent.append(method)
+
+    def getresponse(self):
+        raise http.client.RemoteDisconnected('closed')
+
+    def close(self):
+        pass
+
+
+def test_retry_stale_connection(grafana):
+    """Only requests that are safe to repeat are sent again."""
+    client = _deploy.GrafanaClient(grafana.url)
+    stale = _StaleConnection()
+    client._pool.put(stale)
+    assert client.request('GET', 'search')[0] == 200
+    client._pool.get()
+    client._pool.put(stale)
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.request('POST', 'datasources', {'name': 'prom'})
+    assert stale.sent == ['GET', 'POST']
+    assert grafana.datasources == {}
+
+
+def test_search_dashboards_pages(grafana):
+    grafana.dashboards.update(
+        ('service-{}'.format(i), {'title': 'Service {}'.format(i)})
+        for i in range(7))
+    client = _deploy.GrafanaClient(grafana.url)
+    assert client.search_dashboards(limit=3) == sorted(grafana.dashboards)
+    assert client.search_dashboards(limit=7) == sorted(grafana.dashboards)
+    assert grafana.stats.endpoints['GET /api/search'] == 5
+
+
+def test_search_dashboards_without_paging(grafana, monkeypatch):
+    """Grafanas that ignore ``page`` fail rather than truncating."""
+    grafana.dashboards.update(
+        ('service-{}'.format(i), {'title': 'Service {}'.format(i)})
+        for i in range(3))
+    client = _deploy.GrafanaClient(grafana.url)
+    request = client.request
+    monkeypatch.setattr(client, 'request', lambda method, path: request(
+        method, path.replace('&page=', '&ignored=')))
+    with pytest.raises(_deploy.GrafanaError):
+        client.search_dashboards(limit=2)
+
+
+def test_upload_skips_unchanged(grafana, tmpdir):
+    paths = _write_dashboards(tmpdir, 10)
+    client = _deploy.GrafanaClient(
+        grafana.url.replace('//', '//admin:admin@'), pool_size=4, gzip=True)
+    report = _deploy.upload_dashboards(client, paths, concurrency=4)
+    assert len(report.uploaded) == 10 and not report.failed
+    assert grafana.stats.compressed == 10
+    report = _deploy.upload_dashboards(client, paths, concurrency=4)
+    assert report.unchanged == paths
+    assert report.bytesSent == 0
+    client.close()
+    assert grafana.stats.connections <= 4
+
+
+def test_upload_script(grafana, tmpdir):
+    paths = _write_dashboards(tmpdir, 2)
+    assert _deploy.upload(['--grafana-url', grafana.url] + paths) == 0
+    assert sorted(grafana.dashboards) == ['service-0', 'service-1']
+    closed = 'http://127.0.0.1:1'
+    assert _deploy.upload(['--grafana-url', closed] + paths) == 1
+
+
+def test_upload_invalid_dashboards(grafana, tmpdir, capsys):
+    """Broken dashboards are reported without a traceback."""
+    invalid = tmpdir.join('invalid.json')
+    invalid.write('{')
+    undefined = tmpdir.join('undefined.dashboard.py')
+    undefined.write('')
+    for path in (invalid, undefined):
+        assert _deploy.upload(
+            ['--grafana-url', grafana.url, str(path)]) == 1
+        assert str(path) in capsys.readouterr().err
+    assert _deploy.check(['--grafana-url', grafana.url, str(invalid)]) == 1
+    assert grafana.dashboards == {}
+
+
+def test_check_and_prune(grafana, tmpdir):
+    paths = _write_dashboards(tmpdir, 4)
+    url = grafana.url
+    client = _deploy.GrafanaClient(url)
+    _deploy.upload_dashboards(client, paths[:3])
+    grafana.dashboards['service-1']['title'] = 'Service 1 (edited)'
+    grafana.dashboards['old'] = {'title': 'Old', 'tags': ['generated']}
+    grafana.dashboards['manual'] = {'title': 'Manual', 'tags': []}
+    report = _deploy.check_dashboards(client, paths, concurrency=2)
+    assert (report.unchanged, report.drifted, report.missing,
+            report.stale) == (['service-0', 'service-2'], ['service-1'],
+                              ['service-3'], ['manual', 'old'])
+    with pytest.raises(SystemExit):
+        _deploy.check(['--grafana-url', url, '--prune'] + paths)
+    assert _deploy.check(
+        ['--grafana-url', url, '--tag', 'generated', '--prune'] +
+        paths) == 1
+    assert 'old' not in grafana.dashboards
+    assert 'manual' in grafana.dashboards
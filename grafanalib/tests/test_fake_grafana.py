@@ -0,0 +1,48 @@
+"""Tests for the fake Grafana server."""
+
+import time
+
+from grafanalib._deploy import GrafanaClient
+from grafanalib._fake_grafana import FakeGrafana
+
+
+def test_datasources_and_plugins():
+    with FakeGrafana(apps=['app']) as grafana:
+        client = GrafanaClient(grafana.url)
+        data_source = {'name': 'prom', 'type': 'prometheus', 'url': 'a'}
+        status, created = client.request('POST', 'datasources', data_source)
+        assert status == 200
+        assert client.request('POST', 'datasources', data_source)[0] == 409
+        client.request('PUT', 'datasources/{}'.format(created['id']),
+                       dict(data_source, url='b'))
+        assert client.request('GET', 'datasources/name/prom') == (
+            200, dict(data_source, url='b', id=created['id']))
+        assert client.request('GET', 'datasources/name/none')[0] == 404
+        client.request('POST', 'plugins/app/settings',
+                       {'enabled': True, 'jsonData': {'a': 1}})
+        assert client.request('GET', 'plugins/app/settings')[1] == {
+            'id': 'app', 'enabled': True, 'pinned': False,
+            'jsonData': {'a': 1}}
+        assert client.request('GET', 'plugins/other/settings')[0] == 404
+        client.close()
+        assert grafana.stats.connections == 1
+        assert grafana.stats.endpoints[
+            'GET /api/datasources/name/([^/]+)'] == 2
+
+
+def test_injected_errors():
+    with FakeGrafana(error_rate=0.5, seed=1) as grafana:
+        client = GrafanaClient(grafana.url)
+        statuses = [client.request('GET', 'search')[0] for _ in range(100)]
+        assert statuses.count(500) == grafana.stats.errors
+        assert 25 < grafana.stats.errors < 75
+
+
+def test_rate_limit_and_latency():
+    with FakeGrafana(rate_limit=5, latency=0.01) as grafana:
+        client = GrafanaClient(grafana.url)
+        start = time.monotonic()
+        statuses = [client.request('GET', 'search')[0] for _ in range(10)]
+        assert time.monotonic() - start >= 0.1
+        assert statuses.count(429) == grafana.stats.rateLimited > 0
+        assert statuses[:5] == [200] * 5
@@ -0,0 +1,144 @@
+"""Tests for generating dashboards."""
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import grafanalib.core as G
+from grafanalib import _gen
+
+DEFINITION = '''
+import grafanalib.core as G
+dashboard = G.Dashboard(title={title!r}, rows=[])
+'''
+
+
+def _write_definitions(tmpdir, count):
+    paths = []
+    for i in range(count):
+        path = tmpdir.join('service-{}{}'.format(i, _gen.DASHBOARD_SUFFIX))
+        path.write(DEFINITION.format(title='Service {}'.format(i)))
+        paths.append(str(path))
+    return paths
+
+
+def test_encode_dashboard():
+    dashboard = G.Dashboard(title='Service', rows=[])
+    stream = io.StringIO()
+    _gen.write_dashboard(dashboard, stream)
+    assert _gen.encode_dashboard(dashboard) == \
+        stream.getvalue().encode('utf-8')
+
+
+def test_write_dashboards(tmpdir):
+    paths = _write_definitions(tmpdir, 20)
+    _gen.write_dashboards(paths)
+    for path in paths:
+        with open(_gen.get_json_path(path), 'rb') as json_file:
+            assert json_file.read() == _gen.encode_dashboard(
+                _gen.load_dashboard(path))
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        os.path.basename(name)
+        for path in paths for name in (path, _gen.get_json_path(path)))
+
+
+def test_write_dashboards_failure_replaces_nothing(tmpdir):
+    paths = _write_definitions(tmpdir, 3)
+    tmpdir.join('service-0.json').write('old')
+    tmpdir.join('service-2.dashboard.py').write('dashboard = 1 / 0')
+    with pytest.raises(ZeroDivisionError):
+        _gen.write_dashboards(paths)
+    assert tmpdir.join('service-0.json').read() == 'old'
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'service-0.dashboard.py', 'service-0.json', 'service-1.dashboard.py',
+        'service-2.dashboard.py']
+
+
+def test_atomic_file_writer_error(tmpdir):
+    writer = _gen.AtomicFileWriter(max_pending=1)
+    writer.write(str(tmpdir.join('a.json')), b'{}')
+    writer.write(str(tmpdir.join('missing', 'b.json')), b'{}')
+    with pytest.raises(OSError):
+        writer.close()
+    assert tmpdir.listdir() == []
+
+
+def test_atomic_file_writer_other_error(tmpdir):
+    """Errors other than OSError don't stop the writer."""
+    with pytest.raises(TypeError):
+        with _gen.AtomicFileWriter(max_pending=1) as writer:
+            writer.write(str(tmpdir.join('a.json')), 'not bytes')
+            for i in range(5):
+                writer.write(str(tmpdir.join('{}.json'.format(i))), b'{}')
+    assert tmpdir.listdir() == []
+    writer = _gen.AtomicFileWriter()
+    writer.write(str(tmpdir.join('a.json')), 'not bytes')
+    with pytest.raises(TypeError):
+        writer.close()
+    assert tmpdir.listdir() == []
+
+
+def test_bundle_names(tmpdir):
+    paths = [str(tmpdir.join(name + _gen.DASHBOARD_SUFFIX))
+             for name in ('a/x', 'a/b/y', 'ab/z')]
+    assert _gen.bundle_names(paths) == ['a/x.json', 'a/b/y.json', 'ab/z.json']
+    assert _gen.bundle_names(paths[:1]) == ['x.json']
+
+
+def test_bundle_ndjson(tmpdir):
+    paths = _write_definitions(tmpdir, 3)
+    output = str(tmpdir.join('out', 'dashboards.ndjson'))
+    os.mkdir(os.path.dirname(output))
+    assert _gen.generate_dashboards(['-o', output] + paths) == 0
+    with open(output) as bundle:
+        lines = [json.loads(line) for line in bundle]
+    assert [line['path'] for line in lines] == [
+        'service-0.json', 'service-1.json', 'service-2.json']
+    assert lines[1]['dashboard'] == json.loads(
+        _gen.encode_dashboard(_gen.load_dashboard(paths[1])).decode('utf-8'))
+    assert not os.path.exists(_gen.get_json_path(paths[0]))
+
+
+def test_bundle_archives(tmpdir):
+    paths = _write_definitions(tmpdir, 3)
+    expected = {
+        os.path.basename(_gen.get_json_path(path)):
+        _gen.encode_dashboard(_gen.load_dashboard(path))
+        for path in paths
+    }
+    _gen.bundle_dashboards(paths, str(tmpdir.join('out.tar.gz')))
+    with tarfile.open(str(tmpdir.join('out.tar.gz'))) as archive:
+        names = archive.getnames()
+        contents = {
+            name: archive.extractfile(name).read() for name in names}
+    _gen.bundle_dashboards(paths, str(tmpdir.join('out.zip')))
+    with zipfile.ZipFile(str(tmpdir.join('out.zip'))) as archive:
+        assert archive.namelist() == names
+        assert {name: archive.read(name) for name in names} == contents
+    index = json.loads(contents.pop(_gen.ARCHIVE_INDEX).decode('utf-8'))
+    assert contents == expected
+    assert index['dashboards'][0] == {
+        'path': 'service-0.json', 'title': 'Service 0', 'tags': [],
+        'sha1': hashlib.sha1(expected['service-0.json']).hexdigest()}
+
+
+def test_bundle_format(tmpdir):
+    paths = _write_definitions(tmpdir, 1)
+    assert _gen.generate_dashboards(
+        ['-o', str(tmpdir.join('out.txt'))] + paths) == 1
+    assert _gen.generate_dashboards(
+        ['-o', str(tmpdir.join('out.txt')), '--format', 'zip'] + paths) == 0
+    assert zipfile.is_zipfile(str(tmpdir.join('out.txt')))
+
+
+def test_auto_refresh_needs_budget(tmpdir):
+    paths = _write_definitions(tmpdir, 1)
+    with pytest.raises(SystemExit):
+        _gen.generate_dashboards(['--auto-refresh'] + paths)
+    assert _gen.generate_dashboards(
+        ['--auto-refresh', '--query-budget', '100'] + paths) == 0
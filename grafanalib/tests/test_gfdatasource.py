@@ -0,0 +1,289 @@
+"""Tests for the gfdatasource sidecar."""
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import importlib.machinery
+import importlib.util
+import json
+import os
+import socket
+import time
+
+import attr
+import pytest
+
+from grafanalib._fake_grafana import FakeGrafana
+
+requests = pytest.importorskip('requests')
+
+SCRIPT = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'gfdatasource', 'gfdatasource')
+
+
+def _load_script():
+    loader = importlib.machinery.SourceFileLoader('gfdatasource', SCRIPT)
+    spec = importlib.util.spec_from_loader('gfdatasource', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+gf = _load_script()
+
+
+@pytest.fixture
+def grafana():
+    with FakeGrafana(apps=['my-app']) as server:
+        yield server
+
+
+def _api_url(grafana):
+    return grafana.url.replace('//', '//admin:admin@') + '/api'
+
+
+def _api(grafana, **kwargs):
+    return gf.GrafanaAPI(
+        grafana.url + '/api', gf.BasicAuthCredentials('admin', 'admin'),
+        sleep=lambda seconds: None, **kwargs)
+
+
+def _data_source(**kwargs):
+    settings = dict(
+        name='Prometheus', type='prometheus', access='proxy',
+        url='http://prometheus', credentials=None)
+    settings.update(kwargs)
+    return gf.DataSource(**settings)
+
+
+def test_drift():
+    desired = {
+        'url': 'http://prometheus', 'basicAuthPassword': 'secret',
+        'json_data': {'a': 1}, 'secure_json_data': {'b': 2},
+    }
+    current = {'id': 1, 'url': 'http://prometheus', 'jsonData': {'a': 1}}
+    assert gf._drift(desired, current) == []
+    assert gf._drift(desired, dict(current, url='http://other')) == ['url']
+    assert gf._drift(desired, dict(current, jsonData={'a': 2})) == [
+        'json_data']
+    assert gf._drift(desired, dict(current, basicAuthPassword='old')) == [
+        'basicAuthPassword']
+
+
+def test_reconcile_datasource(grafana):
+    api = _api(grafana)
+    assert api.reconcile_datasource(_data_source())
+    assert not api.reconcile_datasource(_data_source())
+    assert api.reconcile_datasource(_data_source(url='http://other'))
+    assert grafana.datasources['Prometheus']['url'] == 'http://other'
+    assert grafana.stats.endpoints == {
+        'GET /api/datasources/name/([^/]+)': 3,
+        'POST /api/datasources': 1,
+        'PUT /api/datasources/(\\d+)': 1,
+    }
+
+
+def test_reconcile_datasource_secrets(grafana):
+    """Grafana hides passwords, so changing one needs a forced write."""
+    api = _api(grafana)
+    assert api.reconcile_datasource(_data_source(
+        credentials=gf.BasicAuthCredentials('user', 'old')))
+    rotated = _data_source(credentials=gf.BasicAuthCredentials('user', 'new'))
+    assert not api.reconcile_datasource(rotated)
+    assert api.reconcile_datasource(rotated, force=True)
+    assert grafana.datasources['Prometheus']['basicAuthPassword'] == 'new'
+
+
+def test_reconcile_app(grafana):
+    api = _api(grafana)
+    app = gf.App(id='my-app', json_data={'a': 1}, secure_json_data=None)
+    assert api.reconcile_app(app)
+    assert not api.reconcile_app(app)
+    assert api.reconcile_app(attr.assoc(app, json_data={'a': 2}))
+    assert grafana.plugins['my-app']['jsonData'] == {'a': 2}
+
+
+class _SyncResults(list):
+    """Records the results of syncs, in place of ``Metrics``."""
+
+    def observe_sync(self, result):
+        self.append(result)
+
+
+def test_sync_missing_app(grafana):
+    """A missing app plugin is a failed sync, not a crash."""
+    api = _api(grafana)
+    app = gf.App(id='missing', json_data={}, secure_json_data=None)
+    results = _SyncResults()
+    assert gf._sync(lambda: api.reconcile_app(app), results) is None
+    app = attr.assoc(app, id='my-app')
+    assert gf._sync(lambda: api.reconcile_app(app), results)
+    assert results == ['failed', 'written']
+
+
+def test_retry_server_errors(grafana):
+    """429s and 500s are retried, with a backoff in between."""
+    statuses = iter([429, 500])
+    grafana.admit = lambda endpoint: next(statuses, None)
+    waits = []
+    api = _api(grafana)
+    api.sleep = waits.append
+    assert api.reconcile_datasource(_data_source())
+    assert len(waits) == 2
+    assert api.breaker.failures == 0
+    assert 'Prometheus' in grafana.datasources
+
+
+def test_retries_exhausted(grafana):
+    """The last failed response is returned once retries run out."""
+    attempts = []
+    grafana.admit = lambda endpoint: attempts.append(endpoint) or 500
+    response = _api(grafana, retries=2)._request(
+        'GET', ['datasources', 'name', 'Prometheus'])
+    assert response.status_code == 500
+    assert len(attempts) == 3
+
+
+def test_breaker_opens():
+    """Once open, the circuit stops requests reaching Grafana."""
+    with FakeGrafana(error_rate=1) as grafana:
+        breaker = gf.CircuitBreaker(threshold=3)
+        api = _api(grafana, retries=5, breaker=breaker)
+        with pytest.raises(gf.CircuitOpenError):
+            api.reconcile_datasource(_data_source())
+        with pytest.raises(gf.CircuitOpenError):
+            api.reconcile_datasource(_data_source())
+        assert grafana.stats.requests == grafana.stats.errors == 3
+        assert gf._sync(
+            lambda: api.reconcile_datasource(_data_source()),
+            gf.Metrics()) is None
+
+
+def test_manifest(tmpdir):
+    with FakeGrafana() as first, FakeGrafana(apps=['my-app']) as second:
+        manifest = tmpdir.join('manifest.json')
+        manifest.write(json.dumps({'grafanas': [
+            {'url': _api_url(first), 'org_id': 2, 'datasources': [
+                {'name': 'Prometheus', 'url': 'http://u:p@prometheus'},
+                {'name': 'Loki', 'url': 'http://loki', 'type': 'loki'},
+            ]},
+            {'url': _api_url(second),
+             'apps': [{'id': 'my-app', 'json_data': {'a': 1}}]},
+        ]}))
+
+        def make_api(base_url, credentials, org_id):
+            return gf.GrafanaAPI(
+                base_url, credentials, org_id=org_id,
+                sleep=lambda seconds: None)
+
+        reconciler = gf.ManifestReconciler(str(manifest), make_api, 4)
+        assert reconciler()
+        assert sorted(first.datasources) == ['Loki', 'Prometheus']
+        assert first.datasources['Prometheus']['basicAuthUser'] == 'u'
+        assert first.datasources['Loki']['type'] == 'loki'
+        assert second.plugins['my-app']['jsonData'] == {'a': 1}
+        assert not reconciler()
+
+
+def test_manifest_reload_closes_sessions(grafana, tmpdir):
+    manifest = tmpdir.join('manifest.json')
+
+    def write_manifest(*names):
+        manifest.write(json.dumps({'grafanas': [{
+            'url': _api_url(grafana),
+            'datasources': [
+                {'name': name, 'url': 'http://prometheus'} for name in names],
+        }]}))
+
+    apis, closed = [], []
+
+    def make_api(base_url, credentials, org_id):
+        apis.append(gf.GrafanaAPI(base_url, credentials))
+        apis[-1].close = functools.partial(closed.append, apis[-1])
+        return apis[-1]
+
+    reconciler = gf.ManifestReconciler(str(manifest), make_api, 2)
+    write_manifest('Prometheus')
+    assert reconciler()
+    write_manifest('Prometheus', 'Staging')
+    assert reconciler()
+    assert sorted(grafana.datasources) == ['Prometheus', 'Staging']
+    assert len(apis) == 2
+    assert closed == apis[:1]
+
+
+def test_breaker_shared_between_threads():
+    """Failures from many threads are all counted."""
+    breaker = gf.CircuitBreaker(threshold=3200)
+
+    def fail(_):
+        for _ in range(100):
+            breaker.record_failure()
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(fail, range(32)))
+    assert breaker.failures == 3200
+    assert not breaker.allow()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _get(url):
+    """Get a URL, waiting for the server to come up."""
+    for _ in range(50):
+        try:
+            return requests.get(url)
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    return requests.get(url)
+
+
+def test_serve_metrics():
+    pytest.importorskip('prometheus_client')
+    port = _free_port()
+    metrics = gf._serve_metrics(port)
+    metrics.observe_request('GET', 'datasources/name', 200, 0.1)
+    metrics.observe_sync('in_sync')
+    response = _get('http://127.0.0.1:{}/metrics'.format(port))
+    assert response.status_code == 200
+    assert ('gfdatasource_requests_total{endpoint="datasources/name",'
+            'method="GET",status="200"} 1.0') in response.text
+    assert 'gfdatasource_syncs_total{result="in_sync"} 1.0' in response.text
+
+
+class _Stop(Exception):
+    pass
+
+
+def test_watch_updates_rotated_credentials(tmpdir, monkeypatch):
+    """Rotated credentials are written over the existing data source."""
+    secret = tmpdir.join('prometheus')
+    secret.write('user:old')
+    watch = gf.watch_forever
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 1:
+            secret.write('user:rotated')
+        else:
+            raise _Stop()
+
+    def watch_forever(*args, **kwargs):
+        return watch(*args, sleep=sleep, **kwargs)
+
+    monkeypatch.setattr(gf, 'watch_forever', watch_forever)
+    with FakeGrafana() as grafana:
+        monkeypatch.setattr('sys.argv', [
+            'gfdatasource', '--grafana-url', _api_url(grafana),
+            '--watch', str(secret), 'datasource',
+            '--data-source-url', 'http://prometheus',
+            '--data-source-credentials-file', str(secret)])
+        with pytest.raises(_Stop):
+            gf.main()
+        assert grafana.datasources['Prometheus']['basicAuthPassword'] == \
+            'rotated'
+        assert grafana.stats.endpoints['PUT /api/datasources/(\\d+)'] == 1
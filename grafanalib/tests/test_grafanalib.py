@@ -2,6 +2,9 @@
 
 from io import StringIO
 
+import attr
+import pytest
+
 import grafanalib.core as G
 from grafanalib import _gen
 
@@ -56,3 +59,214 @@ def test_auto_id():
         ],
     ).auto_panel_ids()
     assert dashboard.rows[0].panels[0].id == 1
+
+
+def _single_stat(**kwargs):
+    return G.SingleStat(
+        title="Up",
+        dataSource="My data source",
+        targets=[G.Target(expr='up', refId='A')],
+        **kwargs
+    )
+
+
+def test_single_stat_current_value_uses_instant_query():
+    """Single stats that only need the latest value run instant queries."""
+    panel = _single_stat(valueName=G.VTYPE_CURR)
+    [target] = panel.to_json_data()['targets']
+    assert target.to_json_data()['instant'] is True
+
+
+def test_single_stat_explicit_range_query():
+    """Explicitly setting ``instant`` on a target is respected."""
+    panel = G.SingleStat(
+        title="Up",
+        dataSource="My data source",
+        targets=[G.Target(expr='up', refId='A', instant=False)],
+        valueName=G.VTYPE_CURR,
+    )
+    [target] = panel.to_json_data()['targets']
+    assert target.to_json_data()['instant'] is False
+
+
+def test_find_range_query_single_stats():
+    """Single stats that need range queries are flagged."""
+    average = _single_stat(valueName=G.VTYPE_AVG)
+    current = _single_stat(valueName=G.VTYPE_CURR)
+    sparkline = _single_stat(
+        valueName=G.VTYPE_CURR, sparkline=G.SparkLine(show=True))
+    dashboard = G.Dashboard(
+        title="Test dashboard",
+        rows=[G.Row(panels=[average, current, sparkline])],
+    )
+    flagged = G.find_range_query_single_stats(dashboard)
+    assert flagged == [average, sparkline]
+
+
+def _busy_dashboard(**kwargs):
+    return G.Dashboard(
+        title="Busy dashboard",
+        rows=[G.Row(panels=[
+            G.Graph(
+                title="Graph {}".format(i),
+                dataSource="My data source",
+                targets=[G.Target(expr='up', refId='A'),
+                         G.Target(expr='down', refId='B')],
+            ) for i in range(5)
+        ])],
+        **kwargs
+    )
+
+
+def test_interval_to_seconds():
+    assert G.interval_to_seconds('10s') == 10
+    assert G.interval_to_seconds('5m') == 300
+    assert G.interval_to_seconds('-24h') == 86400
+    assert G.interval_to_seconds(30) == 30
+
+
+def test_query_load():
+    """Every target is queried once per refresh."""
+    load = _busy_dashboard(refresh='10s').query_load()
+    assert load.panelQueries == 10
+    assert load.per_minute() == 60
+
+
+def test_auto_refresh():
+    """auto_refresh() picks the shortest interval within budget."""
+    dashboard = _busy_dashboard(refresh='5s').auto_refresh(budget=20)
+    assert dashboard.refresh == '30s'
+
+
+def test_auto_refresh_without_refresh():
+    """Dashboards that don't refresh automatically are left alone."""
+    dashboard = _busy_dashboard(refresh=None)
+    assert dashboard.auto_refresh(budget=100) is dashboard
+
+
+def test_auto_refresh_impossible():
+    with pytest.raises(ValueError):
+        _busy_dashboard().auto_refresh(budget=0)
+
+
+def test_query_budget_exceeded():
+    """Generation fails when a dashboard goes over its query budget."""
+    with pytest.raises(_gen.DashboardError):
+        _gen.apply_query_budget(_busy_dashboard(), budget=20)
+
+
+def test_share_duplicate_queries():
+    """Panels repeating an earlier panel's queries reuse its results."""
+    targets = [G.Target(expr='up', refId='A')]
+    dashboard = G.Dashboard(
+        title="Test dashboard",
+        rows=[G.Row(panels=[
+            G.Graph(title="Up", dataSource="Prometheus", targets=targets),
+            G.SingleStat(title="Up", dataSource="Prometheus",
+                         targets=targets),
+            G.SingleStat(title="Up now", dataSource="Prometheus",
+                         targets=targets, valueName=G.VTYPE_CURR),
+        ])],
+    )
+    dashboard, saved = dashboard.share_duplicate_queries()
+    graph, single_stat, instant_stat = dashboard.rows[0].panels
+    assert saved == 1
+    assert single_stat.dataSource == G.DASHBOARD_DATA_SOURCE
+    assert single_stat.targets == [G.DashboardTarget(panelId=graph.id)]
+    assert instant_stat.targets == targets
+
+
+def test_share_duplicate_queries_reduces_load():
+    """Panels that reuse another panel's results don't count as queries."""
+    dashboard = _busy_dashboard(refresh='1m')
+    shared, saved = dashboard.share_duplicate_queries()
+    assert saved == 8
+    assert dashboard.query_load().panelQueries == 10
+    assert shared.query_load().panelQueries == 2
+
+
+def test_dashboard_cache_defaults():
+    """Panels inherit the dashboard's cache settings unless they set any."""
+    dashboard = G.Dashboard(
+        title="Test dashboard",
+        cacheTimeout='60',
+        queryTimeout='30s',
+        rows=[G.Row(panels=[
+            G.Graph(title="Up", dataSource="Prometheus", targets=[]),
+            G.SingleStat(title="Up", dataSource="Prometheus", targets=[],
+                         cacheTimeout='10', queryTimeout='2m'),
+            G.Text(content="Hello"),
+        ])],
+    )
+    [row] = dashboard.to_json_data()['rows']
+    graph, single_stat, text = row.panels
+    assert graph.cacheTimeout == '60'
+    assert single_stat.cacheTimeout == '10'
+    assert (graph.queryTimeout, single_stat.queryTimeout) == ('30s', '2m')
+    assert dashboard.rows[0].panels[0].cacheTimeout is None
+
+
+def _template(name, query, default=None):
+    return G.Template(
+        name=name, label=name, query=query, default=default,
+        dataSource="Prometheus")
+
+
+def test_template_static_options():
+    """Templates filled in from an inventory never query their data source.
+    """
+    hosts = {'eu': ['eu-1', 'eu-2'], 'us': ['us-1']}
+    templating = G.Templating(list=[
+        _template('region', 'label_values(region)', default='us'),
+        _template('host', 'label_values(up{region="$region"}, host)'),
+        _template('job', 'label_values(job)'),
+    ]).with_static_options({
+        'region': sorted(hosts),
+        'host': lambda current: hosts[current['region']],
+    })
+    region, host, job = templating.list
+    assert region.refresh == G.REFRESH_NEVER
+    assert region.default == 'us'
+    assert host.options == ['us-1']
+    assert host.default == 'us-1'
+    # host is queried again when another region is picked.
+    assert host.refresh == G.REFRESH_ON_DASHBOARD_LOAD
+    assert job.refresh == G.REFRESH_ON_DASHBOARD_LOAD
+    assert region.to_json_data()['options'] == [
+        {'selected': False, 'text': 'eu', 'value': 'eu'},
+        {'selected': True, 'text': 'us', 'value': 'us'},
+    ]
+
+
+def test_template_static_options_chained():
+    """Chained variables keep refreshing, whichever syntax they use."""
+    templating = G.Templating(list=[
+        _template('region', 'label_values(region)', default='eu'),
+        _template('host', 'label_values(up{region="${region:regex}"}, host)'),
+        _template('disk', 'label_values(disk{host="[[host]]"}, disk)'),
+    ]).with_static_options({
+        'region': ['eu'],
+        'host': lambda current: [current['region'] + '-1'],
+        'disk': lambda current: ['sda'],
+    })
+    region, host, disk = templating.list
+    assert region.refresh == G.REFRESH_NEVER
+    assert host.options == ['eu-1']
+    assert host.refresh == disk.refresh == G.REFRESH_ON_DASHBOARD_LOAD
+
+
+def test_query_load_template_refresh():
+    """Templates refreshed on time range change count towards every refresh.
+    """
+    template = _template('job', 'label_values(job)')
+    dashboard = _busy_dashboard(
+        refresh='1m',
+        templating=G.Templating(list=[
+            template,
+            attr.assoc(template, refresh=G.REFRESH_ON_TIME_RANGE_CHANGE),
+            template.with_options(['a', 'b']),
+        ]),
+    )
+    load = dashboard.query_load()
+    assert load.templateQueries == 2
+    assert load.per_minute() == 11
@@ -2,6 +2,9 @@
 
 from io import StringIO
 
+import attr
+import pytest
+
 import grafanalib.core as G
 import grafanalib.opentsdb as O
 from grafanalib import _gen
@@ -30,3 +33,129 @@ def test_serialization_opentsdb_target():
     stream = StringIO()
     _gen.write_dashboard(graph, stream)
     assert stream.getvalue() != ''
+
+
+def _opentsdb_dashboard(*targets, **kwargs):
+    return G.Dashboard(
+        title="OpenTSDB",
+        time=G.Time("now-7d", "now"),
+        rows=[G.Row(panels=[
+            G.Graph(title="CPU", dataSource="OpenTSDB",
+                    targets=list(targets), span=6, **kwargs),
+        ])],
+    )
+
+
+def _targets(dashboard):
+    return [t for p in dashboard._iter_panels() for t in p.targets]
+
+
+def test_downsample_interval():
+    assert O.downsample_interval(3600, 960) == '10s'
+    assert O.downsample_interval(7 * 86400, 960) == '30m'
+    assert O.downsample_interval(10 * 365 * 86400, 960) == '1w'
+
+
+def test_auto_downsample():
+    dashboard = _opentsdb_dashboard(
+        O.OpenTSDBTarget(metric='cpu'),
+        O.OpenTSDBTarget(metric='cpu', aggregator=O.OTSDB_AGG_MAX),
+        O.OpenTSDBTarget(metric='cpu', downsampleInterval='1h'),
+    )
+    targets = _targets(O.auto_downsample(dashboard))
+    assert [(t.downsampleInterval, t.downsampleAggregator,
+             t.downsampleFillPolicy) for t in targets] == [
+        (None, O.OTSDB_AGG_AVG, 'null'),
+        (None, O.OTSDB_AGG_MAX, 'null'),
+        ('1h', O.OTSDB_AGG_SUM, 'none'),
+    ]
+
+
+def test_auto_downsample_wider_range():
+    """Downsampled targets still fit when viewed over a longer range."""
+    dashboard = O.auto_downsample(
+        _opentsdb_dashboard(O.OpenTSDBTarget(metric='cpu')))
+    wider = attr.assoc(dashboard, time=G.Time("now-30d", "now"))
+    assert O.find_raw_resolution_targets(wider) == []
+
+
+def test_raw_resolution_warning():
+    raw = O.OpenTSDBTarget(metric='cpu', disableDownsampling=True)
+    fine = O.OpenTSDBTarget(metric='cpu', downsampleInterval='1m')
+    dashboard = _opentsdb_dashboard(raw, fine)
+    found = O.find_raw_resolution_targets(dashboard)
+    assert [(target, points) for _, target, points in found] == [
+        (raw, 60480), (fine, 10080)]
+    with pytest.warns(O.RawResolutionWarning):
+        assert _targets(O.auto_downsample(dashboard)) == [raw, fine]
+    hour = _opentsdb_dashboard(raw, fine, timeFrom='1h')
+    assert O.find_raw_resolution_targets(hour) == []
+
+
+def _host_target(host, refId, **kwargs):
+    return O.OpenTSDBTarget(
+        metric='cpu', refId=refId, alias='{} cpu'.format(host),
+        filters=[
+            O.OpenTSDBFilter(value='prod', tag='env'),
+            O.OpenTSDBFilter(value=host, tag='host'),
+        ], **kwargs)
+
+
+def test_coalesce_targets():
+    dashboard = _opentsdb_dashboard(
+        _host_target('web-1', 'A'),
+        _host_target('web-2', 'B'),
+        _host_target('web-3', 'C', aggregator=O.OTSDB_AGG_MAX),
+        O.OpenTSDBTarget(metric='memory', refId='D'),
+    )
+    coalesced, saved = O.coalesce_targets(dashboard)
+    assert saved == 1
+    targets = _targets(coalesced)
+    assert [t.refId for t in targets] == ['A', 'C', 'D']
+    assert targets[0].alias == '$tag_host cpu'
+    assert targets[0].filters == [
+        O.OpenTSDBFilter(value='prod', tag='env'),
+        O.OpenTSDBFilter(value='web-1|web-2', tag='host', groupBy=True),
+    ]
+    assert targets[1:] == _targets(dashboard)[2:]
+
+
+def test_coalesce_targets_keeps_aliases():
+    dashboard = _opentsdb_dashboard(
+        _host_target('web-1', 'A'),
+        attr.assoc(_host_target('web-2', 'B'), alias='Second host'),
+    )
+    assert O.coalesce_targets(dashboard) == (dashboard, 0)
+
+
+def test_rollups():
+    rollups = O.OpenTSDBRollups(intervals=['1h', '1m'])
+    long_range = _opentsdb_dashboard(
+        O.OpenTSDBTarget(metric='cpu'),
+        O.OpenTSDBTarget(metric='cpu', downsampleInterval='30m'),
+        O.OpenTSDBTarget(metric='cpu', downsampleAggregator=O.OTSDB_AGG_P99),
+    )
+    targets = _targets(rollups.apply(long_range))
+    assert [(t.downsampleInterval, t.rollupUsage) for t in targets] == [
+        ('1h', O.OTSDB_ROLLUP_FALLBACK_RAW), ('30m', None), (None, None)]
+    assert targets[0].to_json_data()['rollupUsage'] == 'ROLLUP_FALLBACK_RAW'
+    assert 'rollupUsage' not in targets[1].to_json_data()
+    short_range = _opentsdb_dashboard(
+        O.OpenTSDBTarget(metric='cpu'), timeFrom='1h')
+    assert rollups.apply(short_range) == short_range
+
+
+def test_rollups_validation():
+    with pytest.raises(ValueError):
+        O.OpenTSDBTarget(metric='cpu', rollupUsage='ROLLUP_SOMETIMES')
+    with pytest.raises(ValueError):
+        O.OpenTSDBRollups(intervals=['hourly'])
+    rollups = O.OpenTSDBRollups(intervals=['1h'])
+    missing = O.OpenTSDBTarget(
+        metric='cpu', downsampleInterval='30m',
+        rollupUsage=O.OTSDB_ROLLUP_NOFALLBACK)
+    with pytest.raises(ValueError):
+        rollups.check(missing)
+    rollups.check(attr.assoc(missing, downsampleInterval='1h'))
+    with pytest.raises(ValueError):
+        rollups.apply(_opentsdb_dashboard(missing))
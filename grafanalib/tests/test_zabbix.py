@@ -2,6 +2,8 @@
 
 from io import StringIO
 
+import attr
+
 import grafanalib.core as G
 import grafanalib.zabbix as Z
 from grafanalib import _gen
@@ -47,3 +49,59 @@ def test_serialization_zabbix_trigger_panel():
     stream = StringIO()
     _gen.write_dashboard(graph, stream)
     assert stream.getvalue() != ''
+
+
+def test_zabbix_function_catalog():
+    """Function definitions are built once and shared by every call."""
+    group_by = Z.ZabbixGroupByFunction(interval="5m", function="max")
+    generic = Z.ZabbixFunction("groupBy", ["5m", "max"])
+    assert generic.to_json_data() == group_by.to_json_data()
+    assert generic.to_json_data()["text"] == "groupBy(5m, max)"
+    assert (group_by.to_json_data()["def"] is
+            Z.ZabbixGroupByFunction().to_json_data()["def"])
+
+
+def _trends_dashboard(time, *targets, **kwargs):
+    return G.Dashboard(
+        title="Trends",
+        time=time,
+        rows=[G.Row(panels=[
+            G.Graph(title="CPU", dataSource="Zabbix", targets=list(targets),
+                    **kwargs),
+        ])],
+    )
+
+
+def _trend_types(dashboard):
+    return [
+        [f.type for f in target.functions
+         if isinstance(f, Z.ZabbixTrendValueFunction)]
+        for panel in dashboard._iter_panels() for target in panel.targets
+    ]
+
+
+def test_zabbix_trends_for_long_ranges():
+    peak = Z.zabbixMetricTarget(
+        "CPU", "Web", "/.*/", "cpu",
+        functions=[Z.ZabbixGroupByFunction(interval="1h", function="max")])
+    average = Z.zabbixMetricTarget("CPU", "Web", "/.*/", "cpu")
+    opt_out = attr.assoc(average, trends=False)
+    month = _trends_dashboard(G.Time("now-30d", "now"),
+                              peak, average, opt_out)
+    assert _trend_types(Z.applyZabbixTrends(month)) == [["max"], ["avg"], []]
+    hour = _trends_dashboard(G.DEFAULT_TIME, peak, average)
+    assert Z.applyZabbixTrends(hour) == hour
+
+
+def test_zabbix_trends_for_time_shifts():
+    shifted = Z.zabbixMetricTarget(
+        "CPU", "Web", "/.*/", "cpu",
+        functions=[Z.ZabbixTimeShiftFunction(interval="7d")])
+    forced = attr.assoc(
+        Z.zabbixMetricTarget("CPU", "Web", "/.*/", "cpu"), trends=True)
+    dashboard = _trends_dashboard(G.Time("now-1d", "now"), shifted, forced)
+    assert _trend_types(Z.applyZabbixTrends(dashboard)) == [["avg"], ["avg"]]
+    dashboard = _trends_dashboard(
+        G.DEFAULT_TIME, Z.zabbixMetricTarget("CPU", "Web", "/.*/", "cpu"),
+        timeShift="8d")
+    assert _trend_types(Z.applyZabbixTrends(dashboard)) == [["avg"]]
@@ -0,0 +1,84 @@
+"""Tests for local evaluation of Zabbix function pipelines."""
+
+import numpy as np
+import pytest
+
+import grafanalib.zabbix as Z
+from grafanalib import zabbix_eval
+
+
+def _series():
+    # Two minutes of one point every 30s, for three hosts.
+    return zabbix_eval.TimeSeries(
+        times=[0, 30, 60, 90],
+        values=[[1, 3, 5, 7],
+                [10, 20, np.nan, 40],
+                [0, 0, 0, 0]],
+        names=['web-1 cpu', 'web-2 cpu', 'db-1 cpu'],
+    )
+
+
+def test_group_by_and_scale():
+    result = zabbix_eval.apply_functions([
+        Z.ZabbixGroupByFunction(interval="1m", function="max"),
+        Z.ZabbixScaleFunction(factor=2),
+    ], _series())
+    assert list(result.times) == [0, 60]
+    assert result.values.tolist() == [[6, 14], [40, 80], [0, 0]]
+    assert result.names == _series().names
+
+
+def test_delta():
+    result = zabbix_eval.apply_functions(
+        [Z.ZabbixDeltaFunction()], _series())
+    assert list(result.times) == [30, 60, 90]
+    assert result.values[0].tolist() == [2, 2, 2]
+
+
+def test_functions_applied_by_category():
+    # aggregateBy is listed first, but runs after top, as in Grafana-Zabbix.
+    result = zabbix_eval.apply_functions([
+        Z.ZabbixAggregateByFunction(interval="2m", function="avg"),
+        Z.ZabbixTopFunction(number=2, function="max"),
+    ], _series())
+    assert result.values.tolist() == [[np.mean([1, 3, 5, 7, 10, 20, 40])]]
+
+
+def test_top_bottom_and_aliases():
+    series = _series()
+    top = zabbix_eval.apply_functions([
+        Z.ZabbixTopFunction(number=1, function="avg"),
+        Z.ZabbixSetAliasByRegexFunction(regexp=r"^[a-z]+-\d+"),
+    ], series)
+    assert top.names == ['web-2']
+    bottom = zabbix_eval.apply_functions(
+        [Z.ZabbixBottomFunction(number=2)], series)
+    assert bottom.names == ['web-1 cpu', 'db-1 cpu']
+    alias = zabbix_eval.apply_functions(
+        [Z.ZabbixFunction("setAlias", ["cpu"])], series)
+    assert alias.names == ['cpu'] * 3
+
+
+def test_top_without_points():
+    """A time window without data keeps its series, and has no points."""
+    series = zabbix_eval.TimeSeries(
+        times=[], values=np.empty((2, 0)), names=['web-1', 'web-2'])
+    for function in (Z.ZabbixTopFunction(number=1),
+                     Z.ZabbixBottomFunction(number=1)):
+        result = zabbix_eval.apply_functions([function], series)
+        assert result.names == ['web-1', 'web-2']
+        assert result.values.shape == (2, 0)
+
+
+def test_time_shift_and_sum_series():
+    result = zabbix_eval.evaluate(Z.zabbixMetricTarget(
+        application="CPU", group="Web", host="/.*/", item="cpu",
+        functions=[Z.ZabbixTimeShiftFunction(interval="24h"),
+                   Z.ZabbixSumSeriesFunction()]), _series())
+    assert list(result.times) == [86400, 86430, 86460, 86490]
+    assert result.values.tolist() == [[11, 23, 5, 47]]
+
+
+def test_mismatched_names():
+    with pytest.raises(ValueError):
+        zabbix_eval.TimeSeries(times=[0, 1], values=[1, 2], names=['a', 'b'])
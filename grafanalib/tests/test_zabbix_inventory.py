@@ -0,0 +1,62 @@
+"""Tests for estimating how many Zabbix items targets match."""
+
+import json
+
+import grafanalib.core as G
+import grafanalib.zabbix as Z
+from grafanalib import zabbix_inventory
+
+
+def _inventory():
+    return zabbix_inventory.Inventory([
+        {"host": "web-{}".format(i),
+         "groups": [{"name": "Web servers"}],
+         "items": [
+             {"name": "CPU load", "applications": [{"name": "CPU"}]},
+             {"name": "Free memory", "applications": ["Memory"]},
+         ]}
+        for i in range(10)
+    ] + [
+        {"host": "db-1",
+         "groups": ["Databases"],
+         "items": [{"name": "CPU load", "applications": ["CPU"]}]},
+    ])
+
+
+def test_compile_filter():
+    assert zabbix_inventory.compile_filter("web-1")("web-1")
+    assert not zabbix_inventory.compile_filter("web-1")("web-10")
+    assert zabbix_inventory.compile_filter("/^web-1$/")("web-1")
+    assert zabbix_inventory.compile_filter("/WEB/i")("web-1")
+    assert zabbix_inventory.compile_filter("$host")("anything")
+    assert (zabbix_inventory.compile_filter("/.*/") is
+            zabbix_inventory.compile_filter("/.*/"))
+
+
+def test_count_targets():
+    inventory = _inventory()
+    assert inventory.count(Z.zabbixMetricTarget(
+        "CPU", "/.*/", "/.*/", "/.*/")) == 11
+    assert inventory.count(Z.zabbixMetricTarget(
+        "", "Web servers", "/web-[12]$/", "/.*/")) == 4
+    assert inventory.count(Z.zabbixMetricTarget(
+        "CPU", "Databases", "db-1", "Free memory")) == 0
+    assert inventory.count(Z.ZabbixTrigger(group="/.*/", host="db-1")) == 1
+
+
+def test_find_expensive_targets(tmpdir):
+    path = tmpdir.join('inventory.json')
+    path.write(json.dumps(_inventory().hosts))
+    inventory = zabbix_inventory.load_inventory(str(path))
+    everything = Z.zabbixMetricTarget("", "/.*/", "/.*/", "/.*/")
+    one = Z.zabbixMetricTarget("CPU", "Databases", "db-1", "CPU load")
+    dashboard = G.Dashboard(title="Zabbix", rows=[G.Row(panels=[
+        G.Graph(title="All", dataSource="Zabbix", targets=[everything, one]),
+        Z.ZabbixTriggersPanel(dataSource="Zabbix", title="Triggers"),
+    ])])
+    costs = zabbix_inventory.target_costs([dashboard], inventory)
+    assert [cost.items for cost in costs] == [21, 1, 0]
+    expensive = zabbix_inventory.find_expensive_targets(
+        [dashboard], inventory, threshold=10)
+    assert [(cost.panel, cost.target) for cost in expensive] == [
+        ("All", everything)]
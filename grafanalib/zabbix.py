@@ -1,11 +1,11 @@
 import attr
 import itertools
-from attr.validators import instance_of
+from attr.validators import instance_of, optional
 from numbers import Number
 from grafanalib.validators import is_interval, is_in, is_color_code, is_list_of
 from grafanalib.core import (
     RGBA, Percent, Pixels, DashboardLink,
-    DEFAULT_ROW_HEIGHT, BLANK, GREEN)
+    DEFAULT_ROW_HEIGHT, BLANK, GREEN, interval_to_seconds, panel_time_range)
 
 ZABBIX_TRIGGERS_TYPE = "alexanderzobnin-zabbix-triggers-panel"
 
@@ -123,6 +123,9 @@ class ZabbixTarget(object):
         the returned value.
     :param useCaptureGroups: defines if capture groups should be used during
         metric query
+    :param trends: whether ``applyZabbixTrends`` makes this target read
+        trends. ``None`` lets it decide from the time range, ``False`` opts
+        out and ``True`` always reads trends.
     """
 
     application = attr.ib(default="", validator=instance_of(str))
@@ -140,16 +143,17 @@ class ZabbixTarget(object):
     slaProperty = attr.ib(default=attr.Factory(dict))
     textFilter = attr.ib(default="", validator=instance_of(str))
     useCaptureGroups = attr.ib(default=False, validator=instance_of(bool))
+    trends = attr.ib(default=None, validator=optional(instance_of(bool)))
 
     def to_json_data(self):
         obj = {
-            "application": ZabbixTargetField(self.application),
+            "application": {"filter": self.application},
             "expr": self.expr,
             "functions": self.functions,
-            "group": ZabbixTargetField(self.group),
-            "host": ZabbixTargetField(self.host),
+            "group": {"filter": self.group},
+            "host": {"filter": self.host},
             "intervalFactor": self.intervalFactor,
-            "item": ZabbixTargetField(self.item),
+            "item": {"filter": self.item},
             "mode": self.mode,
             "options": self.options,
             "refId": self.refId,
@@ -173,18 +177,7 @@ class ZabbixDeltaFunction(object):
     added = attr.ib(default=False, validator=instance_of(bool))
 
     def to_json_data(self):
-        text = "delta()"
-        definition = {
-            "category": "Transform",
-            "name": "delta",
-            "defaultParams": [],
-            "params": []}
-        return {
-            "added": self.added,
-            "text": text,
-            "def": definition,
-            "params": [],
-        }
+        return ZABBIX_FUNCTIONS["delta"].call([], self.added)
 
 
 @attr.s
@@ -206,27 +199,8 @@ class ZabbixGroupByFunction(object):
                        validator=is_in(_options))
 
     def to_json_data(self):
-        text = "groupBy({interval}, {function})"
-        definition = {
-            "category": "Transform",
-            "name": "groupBy",
-            "defaultParams": [
-                self._default_interval,
-                self._default_function,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"},
-                {"name": "function",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval, function=self.function),
-            "params": [self.interval, self.function],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["groupBy"].call(
+            [self.interval, self.function], self.added)
 
 
 @attr.s
@@ -243,22 +217,7 @@ class ZabbixScaleFunction(object):
     factor = attr.ib(default=_default_factor, validator=instance_of(Number))
 
     def to_json_data(self):
-        text = "scale({factor})"
-        definition = {
-            "category": "Transform",
-            "name": "scale",
-            "defaultParams": [self._default_factor],
-            "params": [
-                {"name": "factor",
-                 "options": [100, 0.01, 10, -1],
-                 "type": "float"}]
-        }
-        return {
-            "def": definition,
-            "text": text.format(factor=self.factor),
-            "params": [self.factor],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["scale"].call([self.factor], self.added)
 
 
 @attr.s
@@ -281,27 +240,8 @@ class ZabbixAggregateByFunction(object):
                        validator=is_in(_options))
 
     def to_json_data(self):
-        text = "aggregateBy({interval}, {function})"
-        definition = {
-            "category": "Aggregate",
-            "name": "aggregateBy",
-            "defaultParams": [
-                self._default_interval,
-                self._default_function,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"},
-                {"name": "function",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval, function=self.function),
-            "params": [self.interval, self.function],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["aggregateBy"].call(
+            [self.interval, self.function], self.added)
 
 
 @attr.s
@@ -318,24 +258,7 @@ class ZabbixAverageFunction(object):
     interval = attr.ib(default=_default_interval, validator=is_interval)
 
     def to_json_data(self):
-        text = "average({interval})"
-        definition = {
-            "category": "Aggregate",
-            "name": "average",
-            "defaultParams": [
-                self._default_interval,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"}]
-        }
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval),
-            "params": [self.interval],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["average"].call([self.interval], self.added)
 
 
 @attr.s
@@ -352,24 +275,7 @@ class ZabbixMaxFunction(object):
     interval = attr.ib(default=_default_interval, validator=is_interval)
 
     def to_json_data(self):
-        text = "max({interval})"
-        definition = {
-            "category": "Aggregate",
-            "name": "max",
-            "defaultParams": [
-                self._default_interval,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"}]
-        }
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval),
-            "params": [self.interval],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["max"].call([self.interval], self.added)
 
 
 @attr.s
@@ -386,24 +292,7 @@ class ZabbixMedianFunction(object):
     interval = attr.ib(default="1m", validator=is_interval)
 
     def to_json_data(self):
-        text = "median({interval})"
-        definition = {
-            "category": "Aggregate",
-            "name": "median",
-            "defaultParams": [
-                self._default_interval,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"}]
-        }
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval),
-            "params": [self.interval],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["median"].call([self.interval], self.added)
 
 
 @attr.s
@@ -420,24 +309,7 @@ class ZabbixMinFunction(object):
     interval = attr.ib(default=_default_interval, validator=is_interval)
 
     def to_json_data(self):
-        text = "min({interval})"
-        definition = {
-            "category": "Aggregate",
-            "name": "min",
-            "defaultParams": [
-                self._default_interval,
-            ],
-            "params": [
-                {"name": "interval",
-                 "type": "string"}]
-        }
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval),
-            "params": [self.interval],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["min"].call([self.interval], self.added)
 
 
 @attr.s
@@ -453,18 +325,7 @@ class ZabbixSumSeriesFunction(object):
     added = attr.ib(default=False)
 
     def to_json_data(self):
-        text = "sumSeries()"
-        definition = {
-            "category": "Aggregate",
-            "name": "sumSeries",
-            "defaultParams": [],
-            "params": []}
-        return {
-            "added": self.added,
-            "text": text,
-            "def": definition,
-            "params": [],
-        }
+        return ZABBIX_FUNCTIONS["sumSeries"].call([], self.added)
 
 
 @attr.s
@@ -480,27 +341,8 @@ class ZabbixBottomFunction(object):
                        validator=is_in(_options))
 
     def to_json_data(self):
-        text = "bottom({number}, {function})"
-        definition = {
-            "category": "Filter",
-            "name": "bottom",
-            "defaultParams": [
-                self._default_number,
-                self._default_function,
-            ],
-            "params": [
-                {"name": "number",
-                 "type": "string"},
-                {"name": "function",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                number=self.number, function=self.function),
-            "params": [self.number, self.function],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["bottom"].call(
+            [self.number, self.function], self.added)
 
 
 @attr.s
@@ -516,27 +358,8 @@ class ZabbixTopFunction(object):
                        validator=is_in(_options))
 
     def to_json_data(self):
-        text = "top({number}, {function})"
-        definition = {
-            "category": "Filter",
-            "name": "top",
-            "defaultParams": [
-                self._default_number,
-                self._default_function,
-            ],
-            "params": [
-                {"name": "number",
-                 "type": "string"},
-                {"name": "function",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                number=self.number, function=self.function),
-            "params": [self.number, self.function],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["top"].call(
+            [self.number, self.function], self.added)
 
 
 @attr.s
@@ -555,24 +378,7 @@ class ZabbixTrendValueFunction(object):
                    validator=is_in(_options))
 
     def to_json_data(self):
-        text = "trendValue({type})"
-        definition = {
-            "category": "Trends",
-            "name": "trendValue",
-            "defaultParams": [
-                self._default_type,
-            ],
-            "params": [
-                {"name": "type",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                type=self.type),
-            "params": [self.type],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["trendValue"].call([self.type], self.added)
 
 
 @attr.s
@@ -593,24 +399,7 @@ class ZabbixTimeShiftFunction(object):
     interval = attr.ib(default=_default_interval)
 
     def to_json_data(self):
-        text = "timeShift({interval})"
-        definition = {
-            "category": "Time",
-            "name": "timeShift",
-            "defaultParams": [
-                self._default_interval,
-            ],
-            "params": [
-                {"name": "interval",
-                 "options": self._options,
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(
-                interval=self.interval),
-            "params": [self.interval],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["timeShift"].call([self.interval], self.added)
 
 
 @attr.s
@@ -624,20 +413,7 @@ class ZabbixSetAliasFunction(object):
     added = attr.ib(default=False, validator=instance_of(bool))
 
     def to_json_data(self):
-        text = "setAlias({alias})"
-        definition = {
-            "category": "Alias",
-            "name": "setAlias",
-            "defaultParams": [],
-            "params": [
-                {"name": "alias",
-                 "type": "string"}]}
-        return {
-            "def": definition,
-            "text": text.format(alias=self.alias),
-            "params": [self.alias],
-            "added": self.added,
-        }
+        return ZABBIX_FUNCTIONS["setAlias"].call([self.alias], self.added)
 
 
 @attr.s
@@ -652,22 +428,146 @@ class ZabbixSetAliasByRegexFunction(object):
     added = attr.ib(default=False, validator=instance_of(bool))
 
     def to_json_data(self):
-        text = "setAliasByRegex({regexp})"
-        definition = {
-            "category": "Alias",
-            "name": "setAliasByRegex",
-            "defaultParams": [],
-            "params": [
-                {"name": "aliasByRegex",
-                 "type": "string"}]}
+        return ZABBIX_FUNCTIONS["setAliasByRegex"].call(
+            [self.regexp], self.added)
+
+
+@attr.s(frozen=True)
+class ZabbixFunctionDefinition(object):
+    """Definition of a Grafana-Zabbix function, as sent to Grafana.
+
+    Definitions never change, so their JSON is built once and shared by
+    every call of the function. Don't modify it.
+
+    :param category: category the function is listed under in Grafana
+    :param name: function name
+    :param defaultParams: default parameter values
+    :param params: parameter metadata, as dicts with ``name``, ``type`` and
+        optionally ``options``
+    """
+
+    category = attr.ib()
+    name = attr.ib()
+    defaultParams = attr.ib(default=(), convert=tuple)
+    params = attr.ib(default=(), convert=tuple)
+    _json = attr.ib(init=False, cmp=False, repr=False)
+
+    def __attrs_post_init__(self):
+        object.__setattr__(self, '_json', {
+            "category": self.category,
+            "name": self.name,
+            "defaultParams": list(self.defaultParams),
+            "params": list(self.params),
+        })
+
+    def to_json_data(self):
+        return self._json
+
+    def call(self, params, added=False):
+        """Get the JSON for a call of this function with ``params``."""
         return {
-            "def": definition,
-            "text": text.format(regexp=self.regexp),
-            "params": [self.regexp],
-            "added": self.added,
+            "def": self._json,
+            "text": "{}({})".format(
+                self.name, ", ".join(str(param) for param in params)),
+            "params": params,
+            "added": added,
         }
 
 
+def _param(name, type="string", options=None):
+    param = {"name": name, "type": type}
+    if options is not None:
+        param["options"] = options
+    return param
+
+
+ZABBIX_FUNCTIONS = {
+    definition.name: definition for definition in [
+        ZabbixFunctionDefinition("Transform", "delta"),
+        ZabbixFunctionDefinition(
+            "Transform", "groupBy",
+            [ZabbixGroupByFunction._default_interval,
+             ZabbixGroupByFunction._default_function],
+            [_param("interval"),
+             _param("function", options=ZabbixGroupByFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Transform", "scale",
+            [ZabbixScaleFunction._default_factor],
+            [_param("factor", type="float", options=[100, 0.01, 10, -1])]),
+        ZabbixFunctionDefinition(
+            "Aggregate", "aggregateBy",
+            [ZabbixAggregateByFunction._default_interval,
+             ZabbixAggregateByFunction._default_function],
+            [_param("interval"),
+             _param("function",
+                    options=ZabbixAggregateByFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Aggregate", "average",
+            [ZabbixAverageFunction._default_interval],
+            [_param("interval")]),
+        ZabbixFunctionDefinition(
+            "Aggregate", "max",
+            [ZabbixMaxFunction._default_interval],
+            [_param("interval")]),
+        ZabbixFunctionDefinition(
+            "Aggregate", "median",
+            [ZabbixMedianFunction._default_interval],
+            [_param("interval")]),
+        ZabbixFunctionDefinition(
+            "Aggregate", "min",
+            [ZabbixMinFunction._default_interval],
+            [_param("interval")]),
+        ZabbixFunctionDefinition("Aggregate", "sumSeries"),
+        ZabbixFunctionDefinition(
+            "Filter", "bottom",
+            [ZabbixBottomFunction._default_number,
+             ZabbixBottomFunction._default_function],
+            [_param("number"),
+             _param("function", options=ZabbixBottomFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Filter", "top",
+            [ZabbixTopFunction._default_number,
+             ZabbixTopFunction._default_function],
+            [_param("number"),
+             _param("function", options=ZabbixTopFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Trends", "trendValue",
+            [ZabbixTrendValueFunction._default_type],
+            [_param("type", options=ZabbixTrendValueFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Time", "timeShift",
+            [ZabbixTimeShiftFunction._default_interval],
+            [_param("interval", options=ZabbixTimeShiftFunction._options)]),
+        ZabbixFunctionDefinition(
+            "Alias", "setAlias",
+            params=[_param("alias")]),
+        ZabbixFunctionDefinition(
+            "Alias", "setAliasByRegex",
+            params=[_param("aliasByRegex")]),
+    ]
+}
+
+
+@attr.s
+class ZabbixFunction(object):
+    """Any Grafana-Zabbix function from ``ZABBIX_FUNCTIONS``, by name.
+
+    The ``Zabbix*Function`` classes check their parameters; this doesn't,
+    which makes it cheaper to build in bulk.
+
+    :param name: function name, e.g. ``"groupBy"``
+    :param params: list of parameter values
+    :param added: defines if the function was added in the editor
+    """
+
+    name = attr.ib(validator=is_in(ZABBIX_FUNCTIONS))
+    params = attr.ib(default=attr.Factory(list))
+    added = attr.ib(default=False, validator=instance_of(bool))
+
+    def to_json_data(self):
+        return ZABBIX_FUNCTIONS[self.name].call(self.params, self.added)
+
+
 def zabbixMetricTarget(application, group, host, item, functions=[]):
     return ZabbixTarget(
         mode=ZABBIX_QMODE_METRICS,
@@ -700,6 +600,88 @@ def zabbixTextTarget(application, group, host, item, text,
     )
 
 
+def _function_calls(target):
+    """Get the name and parameters of each of a target's functions."""
+    for function in target.functions:
+        function = function.to_json_data()
+        yield function["def"]["name"], function["params"]
+
+
+def _shift_seconds(target):
+    """How far back in time a target's ``timeShift`` functions move it."""
+    shift = 0
+    for name, params in _function_calls(target):
+        if name == "timeShift":
+            seconds = interval_to_seconds(params[0])
+            shift += -seconds if str(params[0]).startswith("+") else seconds
+    return shift
+
+
+def _trend_type(target):
+    """Pick the trend that matches how a target's functions reduce points.
+
+    Graphs of maxima or minima read the trend of the same name, so that
+    peaks aren't averaged away.
+    """
+    for name, params in _function_calls(target):
+        if name in ("groupBy", "aggregateBy") and params[1] in ("min", "max"):
+            return params[1]
+        if name in ("min", "max"):
+            return name
+    return ZabbixTrendValueFunction._default_type
+
+
+def _with_trends(target, start, end, trendsFrom, trendsRange):
+    if not isinstance(target, ZabbixTarget) or target.trends is False:
+        return target
+    if target.mode != ZABBIX_QMODE_METRICS:
+        return target
+    if any(name == "trendValue" for name, _ in _function_calls(target)):
+        return target
+    shift = _shift_seconds(target)
+    if not (target.trends or start + shift >= trendsFrom or
+            start - end > trendsRange):
+        return target
+    return attr.assoc(target, functions=list(target.functions) + [
+        ZabbixTrendValueFunction(type=_trend_type(target))])
+
+
+def applyZabbixTrends(dashboard, trendsFrom="7d", trendsRange="4d"):
+    """Make Zabbix targets that look at long time ranges read trends.
+
+    Zabbix keeps raw history for a short time, and hourly trends for much
+    longer. Grafana-Zabbix reads trends, when the data source enables them,
+    for queries that start more than ``trendsFrom`` ago or that cover more
+    than ``trendsRange``. This applies the same rule to each metrics target,
+    using the dashboard's time range, the panel's ``timeFrom`` and
+    ``timeShift`` and the target's own ``timeShift`` functions, and adds a
+    ``ZabbixTrendValueFunction`` to the targets that read trends, so they
+    read the right trend.
+
+    Targets that set ``trends`` to ``False``, or that already have a
+    ``trendValue`` function, are left alone.
+
+    :param dashboard: ``Dashboard`` with a relative time range, such as
+        ``Time("now-30d", "now")``
+    :param trendsFrom: use trends for queries that start this long ago
+    :param trendsRange: use trends for queries longer than this
+    :return: A new ``Dashboard``
+    """
+    trendsFrom = interval_to_seconds(trendsFrom)
+    trendsRange = interval_to_seconds(trendsRange)
+
+    def apply(panel):
+        targets = getattr(panel, "targets", None)
+        if not targets:
+            return panel
+        start, end = panel_time_range(dashboard, panel)
+        return attr.assoc(panel, targets=[
+            _with_trends(target, start, end, trendsFrom, trendsRange)
+            for target in targets
+        ])
+    return dashboard._map_panels(apply)
+
+
 @attr.s
 class ZabbixColor(object):
     color = attr.ib(validator=is_color_code)
@@ -726,10 +708,10 @@ class ZabbixTrigger(object):
 
     def to_json_data(self):
         return {
-            "application": ZabbixTargetField(self.application),
-            "group": ZabbixTargetField(self.group),
-            "host": ZabbixTargetField(self.host),
-            "trigger": ZabbixTargetField(self.trigger),
+            "application": {"filter": self.application},
+            "group": {"filter": self.group},
+            "host": {"filter": self.host},
+            "trigger": {"filter": self.trigger},
         }
 
 
@@ -740,6 +722,7 @@ class ZabbixTriggersPanel(object):
     :param dataSource: query datasource name
     :param title: panel title
     :param ackEventColor: acknowledged triggers color
+    :param cacheTimeout: metric query result cache ttl
     :param customLastChangeFormat: defines last change field data format.
         See momentjs docs for time format:
         http://momentjs.com/docs/#/displaying/format/
@@ -762,6 +745,10 @@ class ZabbixTriggersPanel(object):
     :param minSpan: defines panel minimum spans
     :param okEventColor: defines color for triggers with Ok status
     :param pageSize: defines number of triggers per panel page
+    :param queryCachingTTL: how long, in milliseconds, data sources with
+        query caching may cache this panel's results
+    :param queryTimeout: how long data sources that support it may take to
+        run this panel's queries, e.g. ``"30s"``
     :param scroll: defines if scroll should be shown
     :param severityField: defines if severity field should be shown
     :param showEvents: defines event type to query (Ok, Problems, All)
@@ -781,6 +768,7 @@ class ZabbixTriggersPanel(object):
     ackEventColor = attr.ib(default=BLANK,
                             validator=instance_of(RGBA))
     ageField = attr.ib(default=True, validator=instance_of(bool))
+    cacheTimeout = attr.ib(default=None)
     customLastChangeFormat = attr.ib(default=False,
                                      validator=instance_of(bool))
     description = attr.ib(default="", validator=instance_of(str))
@@ -804,6 +792,8 @@ class ZabbixTriggersPanel(object):
     okEventColor = attr.ib(default=GREEN,
                            validator=instance_of(RGBA))
     pageSize = attr.ib(default=10, validator=instance_of(int))
+    queryCachingTTL = attr.ib(default=None)
+    queryTimeout = attr.ib(default=None)
     repeat = attr.ib(default=None)
     scroll = attr.ib(default=True, validator=instance_of(bool))
     severityField = attr.ib(default=False, validator=instance_of(bool))
@@ -826,6 +816,7 @@ class ZabbixTriggersPanel(object):
             "title": self.title,
             "ackEventColor": self.ackEventColor,
             "ageField": self.ageField,
+            "cacheTimeout": self.cacheTimeout,
             "customLastChangeFormat": self.customLastChangeFormat,
             "description": self.description,
             "fontSize": self.fontSize,
@@ -843,6 +834,8 @@ class ZabbixTriggersPanel(object):
             "minSpan": self.minSpan,
             "okEventColor": self.okEventColor,
             "pageSize": self.pageSize,
+            "queryCachingTTL": self.queryCachingTTL,
+            "queryTimeout": self.queryTimeout,
             "repeat": self.repeat,
             "scroll": self.scroll,
             "severityField": self.severityField,
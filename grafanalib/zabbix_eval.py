@@ -0,0 +1,258 @@
+"""Local evaluation of Grafana-Zabbix function pipelines.
+
+Apply the ``functions`` of a ``ZabbixTarget``, such as ``groupBy``,
+``scale`` or ``top``, to sample series, without a Zabbix server. This makes
+it possible to preview a pipeline, unit-test it, and benchmark it against
+growing numbers of series.
+
+Like Grafana-Zabbix, functions are applied by category rather than in the
+order they are listed: first the transforms, to each series, then the
+filters, the aggregations, the aliases and finally the time shifts.
+``trendValue`` only picks which Zabbix trends are read, so it has no effect
+here.
+
+Requires NumPy.
+"""
+
+import contextlib
+import re
+import warnings
+
+import attr
+import numpy as np
+
+import grafanalib.core as G
+from grafanalib.zabbix import ZABBIX_FUNCTIONS
+
+CATEGORY_ORDER = (
+    "Trends", "Transform", "Filter", "Aggregate", "Alias", "Time")
+
+
+def _as_2d(values):
+    values = np.asarray(values, dtype=float)
+    return values.reshape(1, -1) if values.ndim == 1 else values
+
+
+@attr.s
+class TimeSeries(object):
+    """A set of series that share their timestamps.
+
+    :param times: ascending Unix timestamps, in seconds
+    :param values: an array with one row per series and one column per
+        timestamp. Missing points are NaN.
+    :param names: the name of each series. Defaults to ``series0``,
+        ``series1``, ...
+    """
+
+    times = attr.ib(convert=lambda times: np.asarray(times, dtype=float))
+    values = attr.ib(convert=_as_2d)
+    names = attr.ib(default=None)
+
+    @values.validator
+    def _check_shape(self, attribute, values):
+        if values.shape[1] != len(self.times):
+            raise ValueError(
+                "{} has {} points, but there are {} timestamps".format(
+                    attribute.name, values.shape[1], len(self.times)))
+
+    def __attrs_post_init__(self):
+        if self.names is None:
+            self.names = [
+                'series{}'.format(i) for i in range(len(self.values))]
+        self.names = list(self.names)
+        if len(self.names) != len(self.values):
+            raise ValueError(
+                "There are {} names for {} series".format(
+                    len(self.names), len(self.values)))
+
+
+def _buckets(times, interval):
+    """Find where each ``interval`` of ``times`` starts.
+
+    :return: A tuple of the start time of each non-empty bucket, and the
+        index of its first point
+    """
+    keys = np.floor(times / G.interval_to_seconds(interval))
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1])
+    if not len(times):
+        starts = starts[:0]
+    return keys[starts] * G.interval_to_seconds(interval), starts
+
+
+@contextlib.contextmanager
+def _ignore_empty():
+    """Silence NumPy's warnings about slices without any numbers."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        yield
+
+
+def _group(values, starts, function, combine):
+    """Reduce ``values`` over the buckets that begin at ``starts``.
+
+    :param combine: also reduce across series, giving a single series
+    """
+    if not len(starts):
+        return values[:1 if combine else len(values), :0]
+    if function == "median":
+        ends = list(starts[1:]) + [values.shape[1]]
+        with _ignore_empty():
+            if combine:
+                return np.array([[np.nanmedian(values[:, a:b])
+                                  for a, b in zip(starts, ends)]])
+            return np.array([np.nanmedian(values[:, a:b], axis=1)
+                             for a, b in zip(starts, ends)]).T
+    if function in ("min", "max"):
+        ufunc = np.fmin if function == "min" else np.fmax
+        result = ufunc.reduceat(values, starts, axis=1)
+        if combine:
+            return ufunc.reduce(result, axis=0, keepdims=True)
+        return result
+    present = ~np.isnan(values)
+    total = np.add.reduceat(np.where(present, values, 0), starts, axis=1)
+    count = np.add.reduceat(present, starts, axis=1)
+    if combine:
+        total = total.sum(axis=0, keepdims=True)
+        count = count.sum(axis=0, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _delta(series):
+    return attr.assoc(
+        series, times=series.times[1:],
+        values=np.diff(series.values, axis=1))
+
+
+def _group_by(series, interval, function):
+    times, starts = _buckets(series.times, interval)
+    return attr.assoc(
+        series, times=times,
+        values=_group(series.values, starts, function, combine=False))
+
+
+def _scale(series, factor):
+    return attr.assoc(series, values=series.values * float(factor))
+
+
+def _aggregate_by(series, interval, function):
+    times, starts = _buckets(series.times, interval)
+    return TimeSeries(
+        times=times,
+        values=_group(series.values, starts, function, combine=True),
+        names=['aggregateBy({}, {})'.format(interval, function)])
+
+
+def _aggregate(function):
+    def aggregate(series, interval):
+        return _aggregate_by(series, interval, function)
+    return aggregate
+
+
+def _sum_series(series):
+    with _ignore_empty():
+        values = np.nansum(series.values, axis=0)
+    values[np.isnan(series.values).all(axis=0)] = np.nan
+    return TimeSeries(times=series.times, values=values, names=['sumSeries'])
+
+
+def _limit(largest):
+    def limit(series, number, function):
+        if not len(series.names) or not len(series.times):
+            return series
+        starts = np.arange(1)
+        ranks = _group(series.values, starts, function, combine=False)[:, 0]
+        order = np.argsort(np.where(np.isnan(ranks), -np.inf, ranks),
+                           kind='mergesort')
+        if largest:
+            order = order[::-1]
+        keep = np.sort(order[:int(number)])
+        return TimeSeries(
+            times=series.times, values=series.values[keep],
+            names=[series.names[i] for i in keep])
+    return limit
+
+
+def _trend_value(series, type):
+    return series
+
+
+def _time_shift(series, interval):
+    shift = G.interval_to_seconds(interval)
+    if str(interval).startswith('+'):
+        shift = -shift
+    return attr.assoc(series, times=series.times + shift)
+
+
+def _set_alias(series, alias):
+    return attr.assoc(series, names=[alias] * len(series.names))
+
+
+def _set_alias_by_regex(series, regexp):
+    pattern = re.compile(regexp)
+
+    def alias(name):
+        match = pattern.search(name)
+        return match.group(0) if match else name
+    return attr.assoc(series, names=[alias(name) for name in series.names])
+
+
+_IMPLEMENTATIONS = {
+    "delta": _delta,
+    "groupBy": _group_by,
+    "scale": _scale,
+    "aggregateBy": _aggregate_by,
+    "average": _aggregate("avg"),
+    "max": _aggregate("max"),
+    "median": _aggregate("median"),
+    "min": _aggregate("min"),
+    "sumSeries": _sum_series,
+    "bottom": _limit(largest=False),
+    "top": _limit(largest=True),
+    "trendValue": _trend_value,
+    "timeShift": _time_shift,
+    "setAlias": _set_alias,
+    "setAliasByRegex": _set_alias_by_regex,
+}
+
+
+def _calls(functions):
+    """Get the name and parameters of each function call.
+
+    Functions can be ``Zabbix*Function`` objects, ``ZabbixFunction`` or
+    their JSON.
+    """
+    for function in functions:
+        if hasattr(function, 'to_json_data'):
+            function = function.to_json_data()
+        name = function["def"]["name"]
+        if name not in _IMPLEMENTATIONS:
+            raise ValueError("Unsupported Zabbix function: {!r}".format(name))
+        yield name, function["params"]
+
+
+def apply_functions(functions, series):
+    """Apply a list of Grafana-Zabbix functions to some series.
+
+    :param functions: list of ``Zabbix*Function``, as in
+        ``ZabbixTarget.functions``
+    :param series: ``TimeSeries`` to apply them to
+    :return: A new ``TimeSeries``
+    """
+    calls = list(_calls(functions))
+    for category in CATEGORY_ORDER:
+        for name, params in calls:
+            if ZABBIX_FUNCTIONS[name].category == category:
+                series = _IMPLEMENTATIONS[name](series, *params)
+    return series
+
+
+def evaluate(target, series):
+    """Apply the functions of a ``ZabbixTarget`` to some series.
+
+    :param target: ``ZabbixTarget``
+    :param series: ``TimeSeries`` standing in for the items the target's
+        filters match
+    :return: A new ``TimeSeries``
+    """
+    return apply_functions(target.functions, series)
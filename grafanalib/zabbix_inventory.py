@@ -0,0 +1,195 @@
+"""Estimate how many Zabbix items the targets of dashboards match.
+
+The ``group``, ``host``, ``application`` and ``item`` filters of a
+``ZabbixTarget`` are either names, or regular expressions between slashes,
+such as ``"/.*/"``. A loose regular expression can make a single target fetch
+the history of thousands of items. This checks targets against a snapshot of
+the Zabbix inventory, so the expensive ones can be found before they are
+deployed.
+
+An inventory is a JSON list of hosts, for example as exported from the
+Zabbix API with ``host.get``::
+
+    [{"host": "web-1",
+      "groups": [{"name": "Web servers"}],
+      "items": [{"name": "CPU load", "applications": [{"name": "CPU"}]}]}]
+
+Groups and applications can also be given as plain strings.
+"""
+
+import functools
+import json
+import re
+
+import attr
+
+from grafanalib import zabbix
+
+#: Targets that match more items than this are reported as expensive.
+DEFAULT_ITEM_THRESHOLD = 500
+
+_REGEX_FILTER = re.compile(r'^/(.+)/([gimsuy]*)$')
+_TEMPLATE_VARIABLE = re.compile(r'\$(\w|\{)')
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_filter(filter):
+    """Compile a Grafana-Zabbix filter into a function that matches names.
+
+    Filters between slashes are regular expressions, and the others are
+    names that must match exactly. Filters that use template variables,
+    such as ``"$host"``, can match anything, so they match every name.
+
+    Compiled filters are cached, so each is only compiled once however many
+    targets use it.
+
+    :return: A function that takes a name and returns whether it matches
+    """
+    if _TEMPLATE_VARIABLE.search(filter):
+        return lambda name: True
+    match = _REGEX_FILTER.match(filter)
+    if not match:
+        return lambda name: name == filter
+    flags = re.IGNORECASE if 'i' in match.group(2) else 0
+    return re.compile(match.group(1), flags).search
+
+
+def _names(values):
+    return [
+        value['name'] if isinstance(value, dict) else value
+        for value in values
+    ]
+
+
+@attr.s
+class Inventory(object):
+    """A snapshot of the hosts and items known to Zabbix.
+
+    The items that each filter matches are cached, so checking many
+    dashboards only matches each distinct filter against the inventory once.
+
+    :param hosts: A list of dicts, one per host. See the module docs.
+    """
+
+    hosts = attr.ib()
+    _items = attr.ib(init=False, repr=False)
+    _matches = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        # For each field, map every distinct name to the items it covers.
+        self._items = {
+            'group': {}, 'host': {}, 'application': {}, 'item': {},
+        }
+        count = 0
+        for host in self.hosts:
+            host_name = host.get('host', host.get('name'))
+            items = range(count, count + len(host.get('items', [])))
+            count += len(items)
+            self._items['host'].setdefault(host_name, set()).update(items)
+            for group in _names(host.get('groups', [])):
+                self._items['group'].setdefault(group, set()).update(items)
+            for index, item in zip(items, host.get('items', [])):
+                self._items['item'].setdefault(
+                    item['name'], set()).add(index)
+                for application in _names(item.get('applications', [])):
+                    self._items['application'].setdefault(
+                        application, set()).add(index)
+
+    def _match(self, field, filter):
+        key = (field, filter)
+        items = self._matches.get(key)
+        if items is None:
+            matcher = compile_filter(filter)
+            items = frozenset().union(*[
+                covered for name, covered in self._items[field].items()
+                if matcher(name)
+            ])
+            self._matches[key] = items
+        return items
+
+    def matching_items(self, group, host, application="", item=None):
+        """Find the items that a set of filters match.
+
+        :param group: host group filter
+        :param host: host filter
+        :param application: application filter. Empty matches all items.
+        :param item: item filter, or ``None`` to match all items
+        :return: A set of item numbers
+        """
+        items = self._match('group', group) & self._match('host', host)
+        if application:
+            items &= self._match('application', application)
+        if item is not None:
+            items &= self._match('item', item)
+        return items
+
+    def count(self, target):
+        """Count the items a ``ZabbixTarget`` or ``ZabbixTrigger`` matches.
+
+        Triggers are counted by the items on the hosts and applications they
+        match, since the inventory doesn't list triggers.
+        """
+        return len(self.matching_items(
+            target.group, target.host, target.application,
+            getattr(target, 'item', None)))
+
+
+def load_inventory(path):
+    """Load an ``Inventory`` from a JSON file."""
+    with open(path) as inventory_file:
+        return Inventory(json.load(inventory_file))
+
+
+@attr.s
+class TargetCost(object):
+    """How many items a target matches.
+
+    :param dashboard: title of the dashboard
+    :param panel: title of the panel
+    :param target: the ``ZabbixTarget`` or ``ZabbixTrigger``
+    :param items: the number of items it matches
+    """
+
+    dashboard = attr.ib()
+    panel = attr.ib()
+    target = attr.ib()
+    items = attr.ib()
+
+
+def _zabbix_targets(panel):
+    triggers = getattr(panel, 'triggers', None)
+    if isinstance(triggers, zabbix.ZabbixTrigger):
+        yield triggers
+    for target in getattr(panel, 'targets', None) or []:
+        if (isinstance(target, zabbix.ZabbixTarget) and
+                target.mode == zabbix.ZABBIX_QMODE_METRICS):
+            yield target
+
+
+def target_costs(dashboards, inventory):
+    """Count the items matched by every Zabbix target on some dashboards.
+
+    :param dashboards: A list of ``Dashboard`` objects
+    :param inventory: An ``Inventory``
+    :return: A list of ``TargetCost``, most expensive first
+    """
+    costs = [
+        TargetCost(dashboard.title, panel.title, target,
+                   inventory.count(target))
+        for dashboard in dashboards
+        for panel in dashboard._iter_panels()
+        for target in _zabbix_targets(panel)
+    ]
+    return sorted(costs, key=lambda cost: cost.items, reverse=True)
+
+
+def find_expensive_targets(dashboards, inventory,
+                           threshold=DEFAULT_ITEM_THRESHOLD):
+    """Find the Zabbix targets that match more than ``threshold`` items.
+
+    :return: A list of ``TargetCost``, most expensive first
+    """
+    return [
+        cost for cost in target_costs(dashboards, inventory)
+        if cost.items > threshold
+    ]
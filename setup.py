@@ -39,13 +39,19 @@ setup(
     extras_require={
         'dev': [
             'flake8',
+            'numpy',
             'pytest',
         ],
+        'numpy': [
+            'numpy',
+        ],
     },
     entry_points={
         'console_scripts': [
             'generate-dashboard=grafanalib._gen:generate_dashboard_script',
             'generate-dashboards=grafanalib._gen:generate_dashboards_script',
+            'upload-dashboards=grafanalib._deploy:upload_script',
+            'check-dashboards=grafanalib._deploy:check_script',
         ],
     },
 )